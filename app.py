@@ -1,32 +1,355 @@
-from flask import Flask, render_template, jsonify, request, stream_with_context, Response
+from flask import Flask, render_template, jsonify, request, stream_with_context, Response, send_file, after_this_request, copy_current_request_context, has_request_context
 from flask_cors import CORS
 from ytmusicapi import YTMusic
+from ytmusicapi.exceptions import YTMusicServerError
 import json
+import copy
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from functools import lru_cache
 from datetime import datetime, timedelta
 import time
+import threading
+import hashlib
+import unicodedata
+import bisect
+import itertools
+import re
+import sqlite3
+import tempfile
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from urllib.parse import urlsplit, urlunsplit, quote
+from werkzeug.http import quote_etag, parse_date, http_date
+from markupsafe import escape
+import image_transcoder
+
+try:
+    import fcntl  # Lock entre workers (não existe no Windows)
+except ImportError:
+    fcntl = None
+
+# Com `python app.py`, os filhos (spawn) do pool de imagens reexecutam este arquivo
+# como __mp_main__ antes de rodar a tarefa. Neles nada de clientes YTMusic, SQLite ou threads.
+SPAWNED_CHILD = __name__ == '__mp_main__'
 
 # ⚡ CACHE SIMPLES - 2 minutos de TTL
-_cache = {}
+# L1 = LRU do processo; L2 = backend compartilhado entre os workers (CACHE_BACKEND)
 _cache_ttl = 120  # 2 minutos
+_cache_max_stale = int(os.getenv('CACHE_MAX_STALE', 30 * 60))  # Quanto tempo um valor vencido ainda pode ser servido
+_cache_max_entries = int(os.getenv('CACHE_MAX_ENTRIES', 500))
+_cache_max_bytes = int(os.getenv('CACHE_MAX_BYTES', 32 * 1024 * 1024))  # 32MB
+_cache_shared_max_entries = int(os.getenv('CACHE_SHARED_MAX_ENTRIES', 5000))
+_cache_sweep_interval = 60  # Segundos entre varreduras de entradas expiradas
+_cache_refreshing = set()  # Chaves com atualização em segundo plano em andamento
+_cache_refresh_lock = threading.Lock()
 
-def get_cached(key):
-    """Retorna valor do cache se válido"""
-    if key in _cache:
-        value, timestamp = _cache[key]
-        if time.time() - timestamp < _cache_ttl:
-            return value
-        else:
-            del _cache[key]  # Limpar cache expirado
+# Máximo de chaves por namespace (prefixo): o <country> das rotas de charts é texto livre
+CACHE_NAMESPACE_LIMITS = {
+    'charts_songs_': 32,
+    'charts_artists_': 32,
+}
+
+def cache_namespace(key):
+    """Prefixo de CACHE_NAMESPACE_LIMITS ao qual a chave pertence (ou None)"""
+    for prefix in CACHE_NAMESPACE_LIMITS:
+        if key.startswith(prefix):
+            return prefix
     return None
 
+class FragmentCache:
+    """L1 do processo: LRU limitado por número de entradas, bytes e chaves por namespace"""
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()  # chave -> (valor, timestamp, tamanho)
+        self._namespace_counts = {}
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def get(self, key):
+        """Retorna (valor, timestamp) ou None"""
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                return None
+            self._items.move_to_end(key)
+            return entry[0], entry[1]
+
+    def set(self, key, value, timestamp):
+        size = len(value.encode('utf-8')) if isinstance(value, str) else len(json.dumps(value))
+        with self._lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                return False
+            self._items[key] = (value, timestamp, size)
+            self.total_bytes += size
+            namespace = cache_namespace(key)
+            if namespace:
+                self._namespace_counts[namespace] = self._namespace_counts.get(namespace, 0) + 1
+                if self._namespace_counts[namespace] > CACHE_NAMESPACE_LIMITS[namespace]:
+                    # Mais antiga (LRU) do mesmo namespace
+                    oldest = next(k for k in self._items if k.startswith(namespace))
+                    self._remove(oldest)
+                    self.evictions += 1
+            while len(self._items) > self.max_entries or self.total_bytes > self.max_bytes:
+                self._remove(next(iter(self._items)))
+                self.evictions += 1
+            return True
+
+    def _remove(self, key):
+        entry = self._items.pop(key, None)
+        if entry is None:
+            return
+        self.total_bytes -= entry[2]
+        namespace = cache_namespace(key)
+        if namespace:
+            self._namespace_counts[namespace] -= 1
+
+    def sweep(self, cutoff):
+        """Remove entradas gravadas antes de cutoff; retorna quantas saíram"""
+        with self._lock:
+            keys = [k for k, entry in self._items.items() if entry[1] < cutoff]
+            for k in keys:
+                self._remove(k)
+            self.expired += len(keys)
+            return len(keys)
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._items),
+                'max_entries': self.max_entries,
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions,
+                'expired': self.expired,
+                'namespaces': dict(self._namespace_counts),
+            }
+
+_cache = FragmentCache(_cache_max_entries, _cache_max_bytes)
+
+class MemoryCacheBackend:
+    """Backend só do processo (sem compartilhamento entre workers)"""
+
+    name = 'memory'
+    shared = False
+
+    def __init__(self):
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._items.get(key)
+
+    def set(self, key, value, timestamp):
+        with self._lock:
+            self._items[key] = (value, timestamp)
+
+    def purge(self, cutoff):
+        with self._lock:
+            keys = [k for k, (_, timestamp) in self._items.items() if timestamp < cutoff]
+            for k in keys:
+                del self._items[k]
+            return len(keys)
+
+    def trim(self, prefix, limit):
+        """Mantém só as limit entradas mais novas com o prefixo"""
+        with self._lock:
+            keys = sorted((k for k in self._items if k.startswith(prefix)),
+                          key=lambda k: self._items[k][1], reverse=True)
+            for k in keys[limit:]:
+                del self._items[k]
+            return max(len(keys) - limit, 0)
+
+class SQLiteCacheBackend:
+    """Backend compartilhado por todos os workers da máquina (SQLite em modo WAL)"""
+
+    name = 'sqlite'
+    shared = True
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()  # Conexões do sqlite3 não podem ser compartilhadas entre threads
+        # Guarda o token OAuth: só o dono lê (o -wal/-shm herdam as permissões do arquivo)
+        os.close(os.open(self.path, os.O_CREAT | os.O_RDWR, 0o600))
+        for suffix in ('', '-wal', '-shm'):  # Arquivos de versões anteriores podem estar com 0644
+            if os.path.exists(self.path + suffix):
+                os.chmod(self.path + suffix, 0o600)
+        # Conexão temporária: uma conexão aberta antes do fork do gunicorn não pode ir para os workers
+        conn = sqlite3.connect(self.path, timeout=2)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache '
+                         '(key TEXT PRIMARY KEY, value TEXT NOT NULL, timestamp REAL NOT NULL)')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=2, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT value, timestamp FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def set(self, key, value, timestamp):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO cache (key, value, timestamp) VALUES (?, ?, ?)',
+            (key, json.dumps(value), timestamp))
+
+    def purge(self, cutoff):
+        return self._connection().execute('DELETE FROM cache WHERE timestamp < ?', (cutoff,)).rowcount
+
+    def trim(self, prefix, limit):
+        """Mantém só as limit entradas mais novas com o prefixo"""
+        return self._connection().execute(
+            'DELETE FROM cache WHERE key IN (SELECT key FROM cache WHERE substr(key, 1, ?) = ? '
+            'ORDER BY timestamp DESC LIMIT -1 OFFSET ?)',
+            (len(prefix), prefix, limit)).rowcount
+
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'sqlite')  # sqlite | memory
+CACHE_SQLITE_PATH = os.getenv('CACHE_SQLITE_PATH',
+                              os.path.join(tempfile.gettempdir(), 'soundpulse-cache.sqlite3'))
+
+def create_cache_backend():
+    """Cria o backend L2 configurado; cai para memória se o SQLite não abrir"""
+    if CACHE_BACKEND == 'sqlite' and not SPAWNED_CHILD:
+        try:
+            backend = SQLiteCacheBackend(CACHE_SQLITE_PATH)
+            print(f"[OK] Cache compartilhado (SQLite): {CACHE_SQLITE_PATH}")
+            return backend
+        except (sqlite3.Error, OSError) as e:
+            print(f"[AVISO] Cache SQLite indisponível, usando memória: {e}")
+    return MemoryCacheBackend()
+
+_cache_backend = create_cache_backend()
+_cache_stats = {'l1_hits': 0, 'l2_hits': 0, 'misses': 0, 'backend_errors': 0}
+
+def _cache_backend_call(method, *args):
+    """Chama o backend L2 sem deixar erro dele derrubar a requisição"""
+    try:
+        return getattr(_cache_backend, method)(*args)
+    except Exception as e:
+        _cache_stats['backend_errors'] += 1
+        print(f"[AVISO] Cache compartilhado ({method}) falhou: {e}")
+        return None
+
+def _cache_lookup(key):
+    """(valor, timestamp) mais novo entre L1 e L2, ou None"""
+    entry = _cache.get(key)
+    if entry is not None and time.time() - entry[1] < _cache_ttl:
+        _cache_stats['l1_hits'] += 1
+        return entry
+    # L1 vazio ou vencido: outro worker pode já ter um valor mais novo
+    shared = _cache_backend_call('get', key)
+    if shared is not None and (entry is None or shared[1] > entry[1]):
+        _cache.set(key, shared[0], shared[1])
+        entry = shared
+        _cache_stats['l2_hits'] += 1
+    elif entry is None:
+        _cache_stats['misses'] += 1
+    return entry
+
 def set_cached(key, value):
     """Salva valor no cache"""
-    _cache[key] = (value, time.time())
+    timestamp = time.time()
+    _cache.set(key, value, timestamp)
+    _cache_backend_call('set', key, value, timestamp)
     return value
 
+def sweep_fragment_cache():
+    """Remove do L1 e do L2 o que passou de ttl + max_stale e aplica os limites do L2"""
+    cutoff = time.time() - _cache_ttl - _cache_max_stale
+    removed = _cache.sweep(cutoff)
+    removed += _cache_backend_call('purge', cutoff) or 0
+    for prefix, limit in CACHE_NAMESPACE_LIMITS.items():
+        removed += _cache_backend_call('trim', prefix, limit) or 0
+    removed += _cache_backend_call('trim', '', _cache_shared_max_entries) or 0
+    return removed
+
+def start_cache_sweeper():
+    """Thread que varre o cache periodicamente (chaves nunca relidas também expiram)"""
+    def loop():
+        while True:
+            time.sleep(_cache_sweep_interval)
+            try:
+                removed = sweep_fragment_cache()
+                if removed:
+                    print(f"[CACHE] Varredura removeu {removed} entradas")
+            except Exception as e:
+                print(f"[AVISO] Varredura do cache falhou: {e}")
+
+    threading.Thread(target=loop, name='cache-sweeper', daemon=True).start()
+
+if not SPAWNED_CHILD:
+    start_cache_sweeper()
+
+def fragment_cache_stats():
+    return dict(_cache_stats, backend=_cache_backend.name, l1=_cache.stats())
+
+def get_cached_or_build(key, build, label=None):
+    """
+    Stale-while-revalidate: valor fresco sai do cache; valor vencido (até
+    _cache_max_stale) é servido na hora e build() roda em segundo plano.
+    Sem nada no cache, build() roda na própria requisição.
+    """
+    entry = _cache_lookup(key)
+    if entry is not None:
+        value, timestamp = entry
+        age = time.time() - timestamp
+        if age < _cache_ttl:
+            print(f"⚡ [CACHE HIT] {label or key}")
+            return value
+        if age < _cache_ttl + _cache_max_stale:
+            print(f"⚡ [CACHE STALE] {label or key} ({int(age)}s)")
+            refresh_cached_in_background(key, build)
+            return value
+    return set_cached(key, build())
+
+def refresh_cached_in_background(key, build):
+    """Atualiza a chave numa thread (no máximo uma atualização por chave)"""
+    with _cache_refresh_lock:
+        if key in _cache_refreshing:
+            return
+        _cache_refreshing.add(key)
+
+    # build() usa render_template/filtros que leem a requisição original
+    @copy_current_request_context
+    def refresh():
+        _upstream_priority.value = 'prefetch'  # Ninguém está esperando: primeira a ceder no rate limit
+        try:
+            set_cached(key, build())
+            print(f"[CACHE] {key} atualizado em segundo plano")
+        except Exception as e:
+            # Mantém o valor antigo; a próxima requisição tenta de novo
+            print(f"[AVISO] Falha ao atualizar {key} em segundo plano: {e}")
+        finally:
+            with _cache_refresh_lock:
+                _cache_refreshing.discard(key)
+
+    threading.Thread(target=refresh, daemon=True).start()
+
 app = Flask(__name__)
 
 # Configuração CORS mais robusta
@@ -68,14 +391,28 @@ def after_request(response):
     elif path.endswith('.html'):
         response.headers['Content-Type'] = 'text/html; charset=utf-8'
     
+    # Pedir client hints ao navegador (o proxy de imagens escolhe o tamanho por eles)
+    if response.mimetype == 'text/html':
+        response.headers['Accept-CH'] = IMAGE_CLIENT_HINTS_ACCEPT
+    
     return response
 
 # ========================================
 # JINJA2 CUSTOM FILTERS
 # ========================================
 
-def highres_thumbnail(url):
-    """Usa proxy para evitar 429 - puxar normal como músicas"""
+# Tamanhos disponíveis para imagens redimensionáveis (googleusercontent =sNNN)
+IMAGE_SIZE_BUCKETS = (120, 226, 400, 800)
+IMAGE_DEFAULT_DPR = 2  # Sem client hints (Safari/Firefox), assumir tela retina
+IMAGE_CLIENT_HINTS_ACCEPT = 'Sec-CH-DPR, Sec-CH-Width, DPR, Width'
+IMAGE_CLIENT_HINTS_VARY = 'Sec-CH-DPR, DPR, Sec-CH-Width, Width, Save-Data'
+
+def highres_thumbnail(url, width=None):
+    """Usa proxy para evitar 429 - puxar normal como músicas
+    
+    width = largura (px CSS) em que a imagem é exibida no template; o proxy
+    combina com os client hints (DPR, Width, Save-Data) para escolher o tamanho.
+    """
     if not url:
         return '/static/images/placeholder.jpg'
     
@@ -111,10 +448,65 @@ def highres_thumbnail(url):
             # Playlists/Podcasts - manter URL original (qualidade limitada pela API)
         
         # USAR PROXY - Solução simples
+        if width:
+            return f'/api/image-proxy?url={quote(url)}&w={int(width)}'
         return f'/api/image-proxy?url={quote(url)}'
     
     return url
 
+# Hosts de imagem do Google/YouTube (os únicos que passam pelo Pillow: transcodificação e sprites)
+IMAGE_KNOWN_HOSTS = ('googleusercontent.com', 'ggpht.com', 'ytimg.com', 'gstatic.com')
+
+def is_known_image_host(url):
+    host = (urlsplit(url).hostname or '').lower()
+    return any(host == known or host.endswith('.' + known) for known in IMAGE_KNOWN_HOSTS)
+
+def is_resizable_image_url(url):
+    """URLs que aceitam troca de tamanho (=sNNN do Google, hqdefault do YouTube)"""
+    if 'googleusercontent.com' in url or 'ggpht.com' in url or 'gstatic.com' in url:
+        return '=' in url
+    return 'ytimg.com' in url and '/hqdefault.jpg' in url
+
+def requested_image_bucket(display_width):
+    """Escolhe o bucket de tamanho pelos client hints e pela largura do template"""
+    def header_number(*names):
+        for name in names:
+            value = request.headers.get(name)
+            if value:
+                try:
+                    return float(value)
+                except ValueError:
+                    pass
+        return None
+    
+    dpr = header_number('Sec-CH-DPR', 'DPR') or IMAGE_DEFAULT_DPR
+    width_hint = header_number('Sec-CH-Width', 'Width')  # Já em pixels físicos
+    save_data = request.headers.get('Save-Data', '').lower() == 'on'
+    
+    if width_hint:
+        pixels = width_hint
+    elif display_width:
+        pixels = display_width * dpr
+    else:
+        return None
+    if save_data:
+        # Economia de dados: 1x em vez da densidade da tela
+        pixels = pixels / max(dpr, 1)
+    
+    for bucket in IMAGE_SIZE_BUCKETS:
+        if pixels <= bucket:
+            return bucket
+    return IMAGE_SIZE_BUCKETS[-1]
+
+def resize_image_url(url, bucket):
+    """Reescreve a URL do upstream para o tamanho do bucket"""
+    if 'ytimg.com' in url:
+        # mqdefault = 320x180 (sem tarjas pretas), hqdefault = 480x360
+        if bucket <= 226:
+            return url.replace('/hqdefault.jpg', '/mqdefault.jpg')
+        return url
+    return url.split('=')[0] + f'=s{bucket}'
+
 # Registrar filtro customizado
 app.jinja_env.filters['highres'] = highres_thumbnail
 
@@ -123,13 +515,16 @@ app.jinja_env.filters['highres'] = highres_thumbnail
 # ========================================
 
 # Configurar YTMusic com OAuth existente
+yt_auth_kwargs = None  # Argumentos para criar mais clientes autenticados (pool)
 try:
     from ytmusicapi.auth.oauth.credentials import OAuthCredentials
     
     # Tentar carregar OAuth de variável de ambiente primeiro (para Render.com)
     oauth_json_env = os.getenv('OAUTH_JSON')
     
-    if oauth_json_env:
+    if SPAWNED_CHILD:
+        yt = None  # Filho do pool de imagens: não fala com o YouTube Music
+    elif oauth_json_env:
         print("[OAuth] OAuth encontrado em variável de ambiente...")
         try:
             # Parse JSON da variável de ambiente
@@ -146,10 +541,12 @@ try:
             )
             
             print(f"[Info] Usando OAuth credentials da variável de ambiente")
+            yt_auth_kwargs = {'auth': copy.deepcopy(oauth_data), 'oauth_credentials': oauth_credentials}
             yt = YTMusic(auth=oauth_data, oauth_credentials=oauth_credentials)
             print("[OK] YTMusic conectado com sucesso (OAuth via ENV)!")
             
         except json.JSONDecodeError as e:
+            yt_auth_kwargs = None
             print(f"[ERRO] Erro ao parsear OAUTH_JSON: {e}")
             print("[AVISO] Usando modo público...")
             yt = YTMusic()
@@ -171,9 +568,11 @@ try:
                 client_secret=client_secret
             )
             
+            yt_auth_kwargs = {'auth': copy.deepcopy(oauth_data), 'oauth_credentials': oauth_credentials}
             yt = YTMusic(auth=oauth_data, oauth_credentials=oauth_credentials)
             print("[OK] YTMusic conectado com sucesso (OAuth via arquivo)!")
         except Exception as e:
+            yt_auth_kwargs = None
             print(f"[ERRO] Erro ao carregar OAuth do arquivo: {e}")
             import traceback
             traceback.print_exc()
@@ -190,74 +589,1709 @@ except Exception as e:
     import traceback
     traceback.print_exc()
     print("[AVISO] Usando modo público...")
+    yt_auth_kwargs = None
     yt = YTMusic()
     yt = None
 
 # Criar instância pública como fallback para quando OAuth der 403
-try:
-    yt_public = YTMusic()
-    print("[OK] YTMusic público criado como fallback para erros 403")
-except:
+if SPAWNED_CHILD:
     yt_public = None
-    print("[AVISO] Falha ao criar YTMusic público")
+else:
+    try:
+        yt_public = YTMusic()
+        print("[OK] YTMusic público criado como fallback para erros 403")
+    except:
+        yt_public = None
+        print("[AVISO] Falha ao criar YTMusic público")
+
+# ========================================
+# RATE LIMIT DO UPSTREAM (token bucket por host + prioridades)
+# ========================================
+# Cada host tem um balde de tokens. Classes de menor prioridade só usam tokens se
+# sobrar uma reserva no balde e esperam menos: sob carga elas são atrasadas ou
+# descartadas primeiro, e o player (watch/lyrics) continua passando.
+UPSTREAM_PRIORITIES = ('playback', 'page', 'suggestions', 'prefetch')
+UPSTREAM_PRIORITY_RESERVE = {'playback': 0.0, 'page': 0.2, 'suggestions': 0.4, 'prefetch': 0.6}  # Fração do balde
+UPSTREAM_PRIORITY_MAX_WAIT = {'playback': 3.0, 'page': 1.5, 'suggestions': 0.3, 'prefetch': 0.0}  # Segundos
+YTMUSIC_HOST = 'music.youtube.com'
+UPSTREAM_RATE_LIMITS = {  # host -> (tokens por segundo, tamanho do balde)
+    YTMUSIC_HOST: (float(os.getenv('YTMUSIC_RATE_LIMIT', 10)), 20),
+}
+UPSTREAM_DEFAULT_RATE_LIMIT = (float(os.getenv('IMAGE_RATE_LIMIT', 50)), 100)  # Hosts de imagem
+UPSTREAM_SHARED_BUCKET = 'images'  # Hosts fora de UPSTREAM_RATE_LIMITS dividem um balde só
+# Endpoints fora da lista contam como 'page'
+ENDPOINT_PRIORITIES = {
+    'get_watch_playlist': 'playback',
+    'get_song_info': 'playback',
+    'get_lyrics': 'playback',
+    'get_radio_playlist': 'playback',
+    'search_suggestions_endpoint': 'suggestions',
+}
+
+_upstream_priority = threading.local()  # Sobrescreve a prioridade na thread (ex.: atualização em segundo plano)
+
+class UpstreamRateLimited(Exception):
+    """Chamada descartada pelo rate limit (não é erro do upstream)"""
+
+def current_upstream_priority():
+    """Classe da chamada atual: override da thread, prefetch do navegador ou endpoint"""
+    priority = getattr(_upstream_priority, 'value', None)
+    if priority:
+        return priority
+    if has_request_context():
+        purpose = request.headers.get('Sec-Purpose') or request.headers.get('Purpose') or ''
+        if 'prefetch' in purpose.lower():
+            return 'prefetch'
+        return ENDPOINT_PRIORITIES.get(request.endpoint, 'page')
+    return 'page'
+
+class TokenBucket:
+    """Balde de tokens de um host"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.allowed = dict.fromkeys(UPSTREAM_PRIORITIES, 0)
+        self.delayed = dict.fromkeys(UPSTREAM_PRIORITIES, 0)
+        self.shed = dict.fromkeys(UPSTREAM_PRIORITIES, 0)
+
+    def acquire(self, priority):
+        """Consome um token ou espera até a espera máxima da classe; retorna segundos esperados"""
+        reserve = self.burst * UPSTREAM_PRIORITY_RESERVE[priority]
+        deadline = time.monotonic() + UPSTREAM_PRIORITY_MAX_WAIT[priority]
+        started = time.monotonic()
+        waited = False
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens - 1 >= reserve:
+                    self.tokens -= 1
+                    self.allowed[priority] += 1
+                    if waited:
+                        self.delayed[priority] += 1
+                    return now - started
+                wait = (reserve + 1 - self.tokens) / self.rate
+                if now + wait > deadline:
+                    self.shed[priority] += 1
+                    raise UpstreamRateLimited(f"Rate limit do upstream: chamada '{priority}' descartada")
+            waited = True
+            time.sleep(wait)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rate': self.rate,
+                'burst': self.burst,
+                'tokens': round(self.tokens, 1),
+                'allowed': dict(self.allowed),
+                'delayed': dict(self.delayed),
+                'shed': dict(self.shed),
+            }
+
+class UpstreamRateLimiter:
+    """TokenBucket por host de UPSTREAM_RATE_LIMITS + um balde comum para os demais.
+
+    Os baldes são do processo: com N workers o limite efetivo é N vezes o configurado.
+    """
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, host, priority=None):
+        priority = priority or current_upstream_priority()
+        # O proxy aceita qualquer URL: um balde por hostname cresceria sem limite
+        name = host if host in UPSTREAM_RATE_LIMITS else UPSTREAM_SHARED_BUCKET
+        with self._lock:
+            bucket = self._buckets.get(name)
+            if bucket is None:
+                rate, burst = UPSTREAM_RATE_LIMITS.get(name, UPSTREAM_DEFAULT_RATE_LIMIT)
+                bucket = self._buckets[name] = TokenBucket(rate, burst)
+        return bucket.acquire(priority)
+
+    def stats(self):
+        with self._lock:
+            buckets = dict(self._buckets)
+        return {
+            'scope': 'process',  # Não coordena entre workers do gunicorn
+            'buckets': {name: bucket.stats() for name, bucket in buckets.items()},
+        }
+
+upstream_limiter = UpstreamRateLimiter()
+
+# ========================================
+# POOL DE CLIENTES YTMUSIC
+# ========================================
+# Cada YTMusic tem sessão HTTP e contexto próprios e não é thread-safe:
+# cada thread pega um cliente do pool, usa sozinha e devolve.
+YTMUSIC_POOL_SIZE = int(os.getenv('YTMUSIC_POOL_SIZE', 4))  # Clientes por pool (OAuth e público)
+YTMUSIC_POOL_CHECKOUT_TIMEOUT = 10  # Segundos esperando um cliente livre
+YTMUSIC_POOL_MAX_FAILURES = 3  # Falhas seguidas até o cliente ser descartado e recriado
+YTMUSIC_POOL_HEALTH_STATUSES = (401, 403, 429)  # Além de 5xx: status que dizem algo sobre o cliente/sessão
+YTMUSIC_HTTP_POOL_MAXSIZE = 4  # Conexões por cliente
+
+def create_ytmusic_session():
+    """Sessão HTTP própria de um cliente do pool (keep-alive, sem retry automático)"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=YTMUSIC_HTTP_POOL_MAXSIZE, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def is_client_health_error(error):
+    """Erro de transporte/sessão (conta para descartar o cliente). ID inválido, 400/404
+    e falha de parse são da chamada, não do cliente."""
+    if isinstance(error, requests.exceptions.RequestException):
+        return True
+    if isinstance(error, YTMusicServerError):
+        match = re.search(r'HTTP (\d{3})', str(error))
+        if match:
+            status = int(match.group(1))
+            return status in YTMUSIC_POOL_HEALTH_STATUSES or status >= 500
+        return True  # Ex.: YTMusicGatedError (sessão barrada por diálogo)
+    return False
+
+class YTMusicClientPool:
+    """Pool de instâncias YTMusic com checkout/devolução e controle de saúde"""
+
+    def __init__(self, name, factory, size, initial=None, prepare=None):
+        self.name = name
+        self.factory = factory
+        self.prepare = prepare  # Chamado em todo checkout (ex.: repassar token OAuth renovado)
+        self.size = size
+        self._idle = []
+        self._failures = {}  # id(cliente) -> falhas seguidas
+        self._created = 0
+        self._cond = threading.Condition()
+        self.checkouts = 0
+        self.waits = 0
+        self.errors = 0
+        self.discarded = 0
+        if initial is not None:
+            self._idle.append(initial)
+            self._created = 1
+
+    def checkout(self, timeout=YTMUSIC_POOL_CHECKOUT_TIMEOUT):
+        """Pega um cliente livre (cria um novo se o pool ainda não está cheio)"""
+        deadline = time.time() + timeout
+        with self._cond:
+            while not self._idle and self._created >= self.size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError(f"Pool {self.name}: nenhum cliente YTMusic livre")
+                self.waits += 1
+                self._cond.wait(remaining)
+            self.checkouts += 1
+            client = self._idle.pop() if self._idle else None
+            if client is None:
+                self._created += 1
+        if client is None:
+            # Criação fora do lock (faz requisição ao YouTube Music)
+            try:
+                client = self.factory()
+            except Exception:
+                with self._cond:
+                    self._created -= 1
+                    self._cond.notify()
+                raise
+        if self.prepare:
+            self.prepare(client)
+        return client
+
+    def checkin(self, client, ok=True):
+        """Devolve o cliente; depois de muitas falhas seguidas ele é descartado"""
+        with self._cond:
+            if ok:
+                self._failures.pop(id(client), None)
+            else:
+                self.errors += 1
+                failures = self._failures.get(id(client), 0) + 1
+                if failures >= YTMUSIC_POOL_MAX_FAILURES:
+                    self._failures.pop(id(client), None)
+                    self._created -= 1
+                    self.discarded += 1
+                    print(f"[AVISO] Pool {self.name}: cliente descartado após {failures} falhas seguidas")
+                    self._cond.notify()
+                    return
+                self._failures[id(client)] = failures
+            self._idle.append(client)
+            self._cond.notify()
+
+    def run(self, func):
+        """Executa func(cliente) com um cliente exclusivo do pool"""
+        upstream_limiter.acquire(YTMUSIC_HOST)  # Antes do checkout: quem espera não prende cliente
+        client = self.checkout()
+        try:
+            result = func(client)
+        except Exception as e:
+            self.checkin(client, ok=not is_client_health_error(e))
+            raise
+        self.checkin(client)
+        return result
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self.size,
+                'created': self._created,
+                'idle': len(self._idle),
+                'in_use': self._created - len(self._idle),
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'errors': self.errors,
+                'discarded': self.discarded,
+            }
+
+def create_auth_client():
+    """Novo cliente com as mesmas credenciais do yt (ou público, se não há OAuth)"""
+    if yt_auth_kwargs:
+        return YTMusic(auth=copy.deepcopy(yt_auth_kwargs['auth']),
+                       oauth_credentials=yt_auth_kwargs['oauth_credentials'],
+                       requests_session=create_ytmusic_session())
+    return YTMusic(requests_session=create_ytmusic_session())
+
+def create_public_client():
+    return YTMusic(requests_session=create_ytmusic_session())
+
+
+# ========================================
+# CIRCUIT BREAKER (403 do OAuth)
+# ========================================
+# Com o token OAuth inválido, toda chamada pagava um 403 antes de ir para o público.
+# Aberto = vai direto para o público; a cada intervalo uma chamada real testa o OAuth.
+YTMUSIC_BREAKER_THRESHOLD = 2  # 403 seguidos para abrir
+YTMUSIC_BREAKER_OPEN_SECONDS = 30  # Primeira espera até testar de novo
+YTMUSIC_BREAKER_MAX_OPEN_SECONDS = 600  # Espera máxima (dobra a cada teste que falha)
+
+class CircuitBreaker:
+    """Estados closed / open / half_open; em half_open só uma chamada de teste passa"""
+
+    def __init__(self, name, threshold, open_seconds, max_open_seconds):
+        self.name = name
+        self.threshold = threshold
+        self.base_open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.open_seconds = open_seconds
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self.short_circuited = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """True se a chamada pode usar o cliente protegido"""
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.time() - self.opened_at >= self.open_seconds:
+                self.state = 'half_open'
+                print(f"[BREAKER] {self.name}: testando recuperação (half-open)")
+                return True
+            self.short_circuited += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != 'closed':
+                print(f"[BREAKER] {self.name}: recuperado, fechando o circuito")
+            self.state = 'closed'
+            self.failures = 0
+            self.open_seconds = self.base_open_seconds
+
+    def record_failure(self):
+        with self._lock:
+            if self.state == 'open':
+                return  # Chamada liberada antes de abrir: não reabre nem estica a janela
+            self.failures += 1
+            if self.state == 'half_open':
+                # Teste falhou: espera mais antes do próximo
+                self.open_seconds = min(self.open_seconds * 2, self.max_open_seconds)
+            elif self.failures < self.threshold:
+                return
+            else:
+                self.trips += 1
+            self.state = 'open'
+            self.opened_at = time.time()
+            print(f"[BREAKER] {self.name}: aberto por {self.open_seconds}s após {self.failures} falhas")
+
+    def record_ignored(self):
+        """Erro que não diz nada sobre o OAuth (ex.: ID inválido): libera o teste em andamento"""
+        with self._lock:
+            if self.state == 'half_open':
+                self.state = 'open'
+                self.opened_at = time.time() - self.open_seconds  # Próxima chamada testa de novo
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'trips': self.trips,
+                'short_circuited': self.short_circuited,
+                'open_seconds': self.open_seconds,
+                'retry_in': max(0, round(self.opened_at + self.open_seconds - time.time(), 1))
+                            if self.state == 'open' else None,
+            }
+
+oauth_breaker = CircuitBreaker('oauth', YTMUSIC_BREAKER_THRESHOLD,
+                               YTMUSIC_BREAKER_OPEN_SECONDS, YTMUSIC_BREAKER_MAX_OPEN_SECONDS)
+
+# ========================================
+# RENOVAÇÃO DO TOKEN OAUTH EM SEGUNDO PLANO
+# ========================================
+# O ytmusicapi só renova o token quando falta < 1 min, dentro da requisição do usuário.
+# Aqui uma thread renova bem antes e repassa o token novo para todos os clientes do pool
+# (e, pelo cache compartilhado, para os outros workers).
+OAUTH_REFRESH_MARGIN = int(os.getenv('OAUTH_REFRESH_MARGIN', 10 * 60))  # Renovar quando faltar menos que isso
+OAUTH_REFRESH_CHECK_INTERVAL = 60
+OAUTH_SHARED_TOKEN_KEY = 'oauth:access_token'
+
+class OAuthTokenRefresher:
+    """Mantém o access token atual e renova antes de expirar"""
+
+    def __init__(self, auth_kwargs):
+        self.auth_kwargs = auth_kwargs
+        self.credentials = auth_kwargs['oauth_credentials']
+        auth = auth_kwargs['auth']
+        self.refresh_token = auth.get('refresh_token')
+        self.access_token = auth.get('access_token')
+        self.expires_at = int(auth.get('expires_at') or 0)
+        self.refreshed_at = None  # Só conhecido depois da primeira renovação
+        self.source = 'startup'
+        self.refreshes = 0
+        self.adopted = 0
+        self.failures = 0
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def apply(self, client):
+        """Atualiza o token do cliente se o nosso for mais novo (chamado no checkout do pool)"""
+        token = getattr(client, '_token', None)
+        if token is None or not self.access_token:
+            return
+        if token.expires_at < self.expires_at:
+            token.update({'access_token': self.access_token,
+                          'expires_in': self.expires_at - int(time.time())})
+
+    def _set_token(self, access_token, expires_at, refreshed_at, source):
+        with self._lock:
+            self.access_token = access_token
+            self.expires_at = expires_at
+            self.refreshed_at = refreshed_at
+            self.source = source
+        # Clientes criados depois já nascem com o token novo
+        self.auth_kwargs['auth']['access_token'] = access_token
+        self.auth_kwargs['auth']['expires_at'] = expires_at
+
+    def adopt_shared(self):
+        """Usa o token que outro worker já renovou, se for mais novo"""
+        if not _cache_backend.shared:
+            return False
+        shared = _cache_backend_call('get', OAUTH_SHARED_TOKEN_KEY)
+        if shared is None:
+            return False
+        token = shared[0]
+        if token.get('expires_at', 0) <= self.expires_at:
+            return False
+        self._set_token(token['access_token'], token['expires_at'], token.get('refreshed_at'), 'shared')
+        self.adopted += 1
+        return True
+
+    def refresh(self):
+        """Renova o access token com o refresh token (um worker por vez)"""
+        lock_file = None
+        try:
+            # Com cache só em memória cada worker renova o próprio token (não há como compartilhar)
+            if fcntl and _cache_backend.shared:
+                lock_file = os.fdopen(os.open(CACHE_SQLITE_PATH + '.oauth.lock', os.O_CREAT | os.O_WRONLY, 0o600), 'w')
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return False  # Outro worker está renovando; a próxima rodada adota o token dele
+
+            fresh = self.credentials.refresh_token(self.refresh_token)
+            now = int(time.time())
+            expires_at = now + int(fresh['expires_in'])
+            self._set_token(fresh['access_token'], expires_at, now, 'refreshed')
+            self.refreshes += 1
+            self.last_error = None
+            if _cache_backend.shared:
+                # timestamp = expires_at: a varredura do cache não apaga um token ainda válido
+                _cache_backend_call('set', OAUTH_SHARED_TOKEN_KEY,
+                                    {'access_token': fresh['access_token'], 'expires_at': expires_at,
+                                     'refreshed_at': now}, expires_at)
+            print(f"[OAuth] Token renovado em segundo plano (expira em {int(fresh['expires_in'])}s)")
+            return True
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e)
+            print(f"[AVISO] Falha ao renovar token OAuth: {e}")
+            return False
+        finally:
+            if lock_file:
+                lock_file.close()
+
+    def check(self):
+        """Uma rodada: adota token compartilhado ou renova se estiver perto de expirar"""
+        if self.expires_at - time.time() > OAUTH_REFRESH_MARGIN:
+            return
+        if self.adopt_shared() and self.expires_at - time.time() > OAUTH_REFRESH_MARGIN:
+            return
+        self.refresh()
+
+    def start(self):
+        def loop():
+            while True:
+                try:
+                    self.check()
+                except Exception as e:
+                    print(f"[AVISO] Renovação do token OAuth falhou: {e}")
+                time.sleep(OAUTH_REFRESH_CHECK_INTERVAL)
+
+        threading.Thread(target=loop, name='oauth-refresher', daemon=True).start()
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return {
+                'expires_in': int(self.expires_at - now) if self.expires_at else None,
+                'token_age': int(now - self.refreshed_at) if self.refreshed_at else None,
+                'source': self.source,
+                'refreshes': self.refreshes,
+                'adopted_from_shared': self.adopted,
+                'failures': self.failures,
+                'last_error': self.last_error,
+            }
+
+def prepare_auth_client(client):
+    if oauth_token_refresher:
+        oauth_token_refresher.apply(client)
+
+if yt_auth_kwargs and yt_auth_kwargs['auth'].get('refresh_token'):
+    oauth_token_refresher = OAuthTokenRefresher(yt_auth_kwargs)
+    oauth_token_refresher.start()
+else:
+    oauth_token_refresher = None
+
+ytmusic_auth_pool = YTMusicClientPool('oauth', create_auth_client, YTMUSIC_POOL_SIZE,
+                                      initial=yt, prepare=prepare_auth_client) if yt else None
+ytmusic_public_pool = YTMusicClientPool('public', create_public_client, YTMUSIC_POOL_SIZE, initial=yt_public) if yt_public else None
+
+# ========================================
+# CACHE DE IMAGENS (LRU)
+# ========================================
+# Cache LRU limitado por BYTES (não por quantidade): uma capa s800 pesa
+# tanto quanto dezenas de thumbnails pequenas
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_BYTES', 64 * 1024 * 1024))  # 64 MB
+IMAGE_CACHE_MAX_ITEM_BYTES = int(os.getenv('IMAGE_CACHE_MAX_ITEM_BYTES', 2 * 1024 * 1024))  # 2 MB
+IMAGE_CACHE_TTL = 3600  # 1 hora de TTL
+
+class ImageCache:
+    """Cache LRU de imagens em memória, limitado por bytes, com TTL preguiçoso"""
+
+    def __init__(self, max_bytes, ttl, max_item_bytes=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_item_bytes = max_item_bytes or max_bytes
+        self._items = OrderedDict()  # chave -> entry (ordem = menos usado primeiro)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.rejected = 0
+
+    def get(self, key):
+        """Retorna a entry se válida (e marca como recém-usada), senão None"""
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if time.time() - entry['timestamp'] >= self.ttl:
+                # TTL preguiçoso: só remove quando alguém tenta ler
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key, content, content_type, **extra):
+        """Adiciona imagem ao cache, removendo as menos usadas até caber no orçamento"""
+        size = len(content)
+        if size > self.max_item_bytes:
+            # Admissão: imagens gigantes expulsariam dezenas de thumbnails
+            with self._lock:
+                self.rejected += 1
+            return None
+        entry = {
+            'content': content,
+            'content_type': content_type,
+            'timestamp': time.time(),
+            'size': size,
+        }
+        entry.update(extra)
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            while self._items and self._bytes + size > self.max_bytes:
+                oldest_key = next(iter(self._items))
+                self._remove(oldest_key)
+                self.evictions += 1
+            self._items[key] = entry
+            self._bytes += size
+        return entry
+
+    def _remove(self, key):
+        entry = self._items.pop(key)
+        self._bytes -= entry['size']
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'items': len(self._items),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 3) if total else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'rejected': self.rejected,
+            }
+
+image_cache = ImageCache(IMAGE_CACHE_MAX_BYTES, IMAGE_CACHE_TTL, IMAGE_CACHE_MAX_ITEM_BYTES)
+
+# ========================================
+# CACHE DE IMAGENS EM DISCO (2º NÍVEL)
+# ========================================
+# Compartilhado entre todos os workers do gunicorn e sobrevive a restarts.
+# Blobs são endereçados por conteúdo (sha256), então URLs diferentes com a
+# mesma imagem ocupam o disco uma única vez.
+IMAGE_DISK_CACHE_DIR = os.getenv('IMAGE_DISK_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'soundpulse-images'))
+IMAGE_DISK_CACHE_MAX_BYTES = int(os.getenv('IMAGE_DISK_CACHE_MAX_BYTES', 512 * 1024 * 1024))  # 512 MB
+IMAGE_DISK_CACHE_TTL = 7 * 24 * 3600  # 7 dias
+IMAGE_DISK_CACHE_STALE_TTL = 30 * 24 * 3600  # Depois do TTL, revalida no upstream (If-None-Match) até 30 dias
+IMAGE_DISK_CACHE_CLEANUP_EVERY = 50  # Verificar tamanho a cada N gravações
+
+class DiskImageCache:
+    """Cache de imagens em disco local, endereçado por conteúdo, com limpeza LRU"""
+
+    def __init__(self, directory, max_bytes, ttl, stale_ttl=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale_ttl = max(stale_ttl or ttl, ttl)
+        self._blobs_dir = os.path.join(directory, 'blobs')
+        self._keys_dir = os.path.join(directory, 'keys')
+        os.makedirs(self._blobs_dir, exist_ok=True)
+        os.makedirs(self._keys_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._writes_since_cleanup = 0
+        self._cleanup_running = False
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.cleanups = 0
+        self.removed = 0
+
+    def _key_path(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self._keys_dir, digest[:2], digest + '.json')
+
+    def _blob_path(self, digest):
+        return os.path.join(self._blobs_dir, digest[:2], digest)
+
+    def _atomic_write(self, path, data):
+        """Grava em arquivo temporário e renomeia (outros workers nunca leem arquivo pela metade)"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def get(self, key, allow_stale=False):
+        """Retorna metadados + caminho do blob, ou None.
+        
+        Com allow_stale=True, entradas que passaram do TTL (mas ainda dentro de
+        stale_ttl) voltam com meta['stale'] = True para serem revalidadas.
+        """
+        key_path = self._key_path(key)
+        meta = None
+        try:
+            with open(key_path, 'r') as f:
+                meta = json.load(f)
+            age = time.time() - meta['timestamp']
+            meta['stale'] = age >= self.ttl
+            if age >= self.stale_ttl:
+                os.unlink(key_path)
+                meta = None
+            elif meta['stale'] and not allow_stale:
+                meta = None
+            else:
+                meta['path'] = self._blob_path(meta['digest'])
+                # Marcar como recém-usado (a limpeza LRU usa o mtime)
+                os.utime(meta['path'])
+        except (OSError, ValueError, KeyError):
+            meta = None
+        with self._lock:
+            if meta is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return meta
+
+    def open_blob(self, meta):
+        """Abre o blob para envio via sendfile (retorna None se sumiu)"""
+        try:
+            # Com o arquivo aberto, uma limpeza concorrente não quebra o envio
+            f = open(meta['path'], 'rb')
+        except OSError:
+            return None
+        meta['size'] = os.fstat(f.fileno()).st_size
+        return f
+
+    def set(self, key, content, content_type, digest=None, **extra):
+        """Grava blob (se ainda não existir) e o índice chave -> blob"""
+        digest = digest or hashlib.sha256(content).hexdigest()
+        meta = {'digest': digest, 'content_type': content_type, 'timestamp': time.time()}
+        meta.update(extra)
+        try:
+            blob_path = self._blob_path(digest)
+            if not os.path.exists(blob_path):
+                self._atomic_write(blob_path, content)
+            self._atomic_write(self._key_path(key), json.dumps(meta).encode('utf-8'))
+        except OSError as e:
+            print(f"[CACHE] Falha ao gravar imagem no disco: {e}")
+            return None
+
+        with self._lock:
+            self.writes += 1
+            self._writes_since_cleanup += 1
+            run_cleanup = self._writes_since_cleanup >= IMAGE_DISK_CACHE_CLEANUP_EVERY and not self._cleanup_running
+            if run_cleanup:
+                self._writes_since_cleanup = 0
+                self._cleanup_running = True
+        if run_cleanup:
+            # Varredura do disco fora da thread do request (set roda no fim do stream)
+            threading.Thread(target=self._background_cleanup, name='disk-cache-cleanup', daemon=True).start()
+        return meta
+
+    def _background_cleanup(self):
+        try:
+            self.cleanup()
+        except Exception as e:
+            print(f"[CACHE] Falha na limpeza do disco: {e}")
+        finally:
+            with self._lock:
+                self._cleanup_running = False
+
+    def refresh(self, key):
+        """Renova o TTL de uma entrada (upstream confirmou que não mudou)"""
+        key_path = self._key_path(key)
+        try:
+            with open(key_path, 'r') as f:
+                meta = json.load(f)
+            meta['timestamp'] = time.time()
+            self._atomic_write(key_path, json.dumps(meta).encode('utf-8'))
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def _scan(self, root):
+        files = []
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        return files
+
+    def cleanup(self):
+        """Remove blobs menos usados até ficar abaixo de 90% do limite (um worker por vez)"""
+        lock_file = None
+        try:
+            if fcntl:
+                lock_file = open(os.path.join(self.directory, '.cleanup.lock'), 'w')
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return  # Outro worker já está limpando
+
+            removed = 0
+            now = time.time()
+            # Índices expirados (blobs órfãos saem pela limpeza LRU abaixo)
+            for mtime, _, path in self._scan(self._keys_dir):
+                if now - mtime >= self.stale_ttl:
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+
+            blobs = self._scan(self._blobs_dir)
+            total = sum(size for _, size, _ in blobs)
+            if total > self.max_bytes:
+                target = self.max_bytes * 0.9
+                blobs.sort()  # mtime mais antigo primeiro
+                for _, size, path in blobs:
+                    if total <= target:
+                        break
+                    try:
+                        os.unlink(path)
+                        total -= size
+                        removed += 1
+                    except OSError:
+                        pass
+            with self._lock:
+                self.cleanups += 1
+                self.removed += removed
+            if removed:
+                print(f"[CACHE] Disco: {removed} imagens removidas (LRU), {total // 1024}KB em uso")
+        finally:
+            if lock_file:
+                lock_file.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'directory': self.directory,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'writes': self.writes,
+                'cleanups': self.cleanups,
+                'removed': self.removed,
+            }
+
+try:
+    image_disk_cache = DiskImageCache(IMAGE_DISK_CACHE_DIR, IMAGE_DISK_CACHE_MAX_BYTES,
+                                      IMAGE_DISK_CACHE_TTL, IMAGE_DISK_CACHE_STALE_TTL)
+    print(f"[OK] Cache de imagens em disco: {IMAGE_DISK_CACHE_DIR}")
+except OSError as e:
+    image_disk_cache = None
+    print(f"[AVISO] Cache de imagens em disco desativado: {e}")
+
+def image_response_headers(content_type, cache_status=None, etag=None, last_modified=None):
+    """Headers padrão das respostas do proxy de imagens (evitam CORB)"""
+    headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type',
+        'Cache-Control': 'public, max-age=86400',
+        'X-Content-Type-Options': 'nosniff',
+        'Content-Type': content_type,
+        'Vary': 'Origin',
+    }
+    if etag:
+        headers['ETag'] = quote_etag(etag)
+    if last_modified:
+        headers['Last-Modified'] = last_modified
+    if cache_status:
+        headers['X-Cache'] = cache_status
+    return headers
+
+def image_etag(digest):
+    """ETag forte derivado do hash do conteúdo"""
+    return digest[:32]
+
+def client_has_image(etag, last_modified):
+    """True se o navegador já tem esta versão (If-None-Match / If-Modified-Since)"""
+    if request.if_none_match:
+        return bool(etag) and request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified:
+        modified = parse_date(last_modified)
+        return modified is not None and modified <= request.if_modified_since
+    return False
+
+def image_not_modified_response(content_type, etag, last_modified, cache_status):
+    """304 sem corpo (o navegador reutiliza a cópia local)"""
+    headers = image_response_headers(content_type, cache_status, etag, last_modified)
+    del headers['Content-Type']
+    return Response(status=304, headers=headers)
+
+# ========================================
+# SINGLE-FLIGHT (coalescência de requisições)
+# ========================================
+
+class InFlightCall:
+    """Chamada em andamento: os seguidores esperam o evento e reutilizam o resultado"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+class SingleFlight:
+    """Garante uma única execução por chave; chamadas concorrentes compartilham resultado ou erro"""
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def begin(self, key):
+        """Retorna (call, is_leader). O líder DEVE chamar finish()."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.followers += 1
+                call.followers += 1
+                return call, False
+            call = self._calls[key] = InFlightCall()
+            self.leaders += 1
+            return call, True
+
+    def finish(self, key, call, result=None, error=None):
+        """Publica o resultado do líder e libera os seguidores (chamadas repetidas são ignoradas)"""
+        if call.event.is_set():
+            return
+        call.result = result
+        call.error = error
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        call.event.set()
+
+    def wait(self, call, timeout=None):
+        """Espera o líder; relança o erro compartilhado se houver"""
+        if not call.event.wait(timeout):
+            raise TimeoutError(f"{self.name}: tempo esgotado esperando chamada em andamento")
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def do(self, key, fn, timeout=None):
+        """Executa fn() uma vez por chave, mesmo com várias threads pedindo ao mesmo tempo"""
+        call, is_leader = self.begin(key)
+        if not is_leader:
+            return self.wait(call, timeout)
+        try:
+            result = fn()
+        except BaseException as e:
+            self.finish(key, call, error=e)
+            raise
+        self.finish(key, call, result=result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._calls),
+                'leaders': self.leaders,
+                'followers': self.followers,
+            }
+
+# ========================================
+# CACHE DE RESPOSTAS DO YTMUSIC (por método)
+# ========================================
+# TTL por método; métodos fora da lista não são cacheados.
+YTMUSIC_CACHE_TTLS = {
+    'get_lyrics': 3 * 24 * 3600,          # Letra praticamente não muda
+    'get_song': 6 * 3600,
+    'get_album': 6 * 3600,
+    'get_artist': 30 * 60,
+    'get_playlist': 10 * 60,
+    'get_podcast': 30 * 60,
+    'get_watch_playlist': 10 * 60,
+    'get_mood_categories': 24 * 3600,
+    'search': 10 * 60,
+    'get_search_suggestions': 60 * 60,
+}
+YTMUSIC_CHARTS_CACHE_TTL = 3 * 3600  # Buscas "de charts" (top hits, lançamentos...)
+YTMUSIC_CACHE_MAX_ENTRIES = int(os.getenv('YTMUSIC_CACHE_MAX_ENTRIES', 1000))
+YTMUSIC_CACHE_ENABLED = os.getenv('YTMUSIC_CACHE', '1') == '1'  # 0 desliga o cache em todos os workers
+YTMUSIC_FLIGHT_WAIT_TIMEOUT = 30  # Tempo máximo esperando uma chamada idêntica em andamento
+
+class YTMusicResponseCache:
+    """Cache LRU das respostas do ytmusicapi (chave = método + argumentos)"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._items = OrderedDict()  # chave -> (expira_em, método, valor)
+        self._lock = threading.Lock()
+        self.hits = {}
+        self.misses = {}
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(method, args, kwargs):
+        return f"{method}:{args!r}:{sorted(kwargs.items())!r}"
+
+    def get(self, method, key):
+        """Retorna (True, cópia do valor) se ainda válido, senão (False, None)"""
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None or time.time() >= entry[0]:
+                if entry is not None:
+                    del self._items[key]
+                self.misses[method] = self.misses.get(method, 0) + 1
+                return False, None
+            self._items.move_to_end(key)
+            self.hits[method] = self.hits.get(method, 0) + 1
+            value = entry[2]
+        # Cópia: os endpoints alteram o resultado (pop de tracks, ensure_thumbnail...)
+        return True, copy.deepcopy(value)
+
+    def set(self, method, key, value, ttl):
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (time.time() + ttl, method, value)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._items),
+                'max_entries': self.max_entries,
+                'hits': dict(self.hits),
+                'misses': dict(self.misses),
+                'evictions': self.evictions,
+            }
+
+ytmusic_cache = YTMusicResponseCache(YTMUSIC_CACHE_MAX_ENTRIES)
+ytmusic_flights = SingleFlight('ytmusic')
+
+def safe_ytmusic_call(method, *args, use_fallback=True, cache_ttl=None, **kwargs):
+    """
+    Executa method (ex.: 'get_artist') do ytmusicapi com fallback automático.
+    Se OAuth der 403, tenta com yt_public.
+
+    A resposta é cacheada por método + argumentos, com TTL de YTMUSIC_CACHE_TTLS
+    (ou cache_ttl); YTMUSIC_CACHE=0 desliga o cache.
+    Chamadas idênticas simultâneas viram uma só ida ao upstream (single-flight);
+    as outras threads recebem uma cópia do mesmo resultado (ou o mesmo erro).
+    """
+    ttl = cache_ttl if cache_ttl is not None else YTMUSIC_CACHE_TTLS.get(method)
+    if not YTMUSIC_CACHE_ENABLED:
+        ttl = 0
+    key = YTMusicResponseCache.make_key(method, args, kwargs)
+    if ttl:
+        found, value = ytmusic_cache.get(method, key)
+        if found:
+            return value
+
+    call, is_leader = ytmusic_flights.begin(key)
+    if not is_leader:
+        # O líder pode alterar o próprio resultado depois; cada seguidor leva uma cópia
+        return copy.deepcopy(ytmusic_flights.wait(call, YTMUSIC_FLIGHT_WAIT_TIMEOUT))
+    try:
+        result = hedged_ytmusic_call(method, lambda ytm: getattr(ytm, method)(*args, **kwargs), use_fallback)
+    except BaseException as e:
+        ytmusic_flights.finish(key, call, error=e)
+        raise
+    if ttl:
+        ytmusic_cache.set(method, key, result, ttl)
+    ytmusic_flights.finish(key, call, result=result)
+    observe_ytmusic_result(method, args, result)
+    if call.followers:
+        return copy.deepcopy(result)
+    return result
+
+def call_ytmusic(func, use_fallback=True):
+    """Chama func(ytm) com um cliente do pool OAuth e, se der 403, do pool público"""
+    if ytmusic_auth_pool is None:
+        if ytmusic_public_pool is None:
+            raise Exception("YTMusic não disponível")
+        return ytmusic_public_pool.run(func)
+
+    # Circuito aberto: OAuth está dando 403, ir direto para o público
+    if use_fallback and ytmusic_public_pool and not oauth_breaker.allow():
+        return ytmusic_public_pool.run(func)
+
+    try:
+        result = ytmusic_auth_pool.run(func)
+    except Exception as e:
+        error_msg = str(e)
+        if "403" not in error_msg:
+            oauth_breaker.record_ignored()
+            raise
+        oauth_breaker.record_failure()
+        # Se for 403 e tivermos fallback público, tentar com ele
+        if use_fallback and ytmusic_public_pool:
+            print(f"[AVISO] OAuth deu 403, tentando com modo público...")
+            try:
+                return ytmusic_public_pool.run(func)
+            except Exception as e2:
+                print(f"[ERRO] Fallback público também falhou: {e2}")
+                raise e  # Lançar erro original
+        raise
+    oauth_breaker.record_success()
+    return result
+
+# ========================================
+# HEDGING (OAuth x público)
+# ========================================
+# Leituras idempotentes: se o OAuth não responder dentro do p90 aprendido do método,
+# a mesma chamada sai também pelo cliente público e vale a primeira que responder.
+YTMUSIC_HEDGE_ENABLED = os.getenv('YTMUSIC_HEDGE', '1') == '1'
+YTMUSIC_HEDGE_METHODS = {'search', 'get_album', 'get_artist', 'get_watch_playlist'}
+YTMUSIC_HEDGE_DEFAULT_DELAY = 1.0  # Até juntar amostras suficientes
+YTMUSIC_HEDGE_MIN_DELAY = 0.15
+YTMUSIC_HEDGE_MIN_SAMPLES = 20
+YTMUSIC_HEDGE_WINDOW = 200  # Latências guardadas por método
+YTMUSIC_HEDGE_MAX_RATIO = 0.1  # No máximo ~10% das chamadas viram hedge
+YTMUSIC_HEDGE_WORKERS = int(os.getenv('YTMUSIC_HEDGE_WORKERS', 32))  # Cobre o fan-out da busca + requisições
+
+class HedgeController:
+    """Aprende o p90 por método, limita a taxa de hedges (crédito por chamada) e as vagas no executor"""
+
+    def __init__(self, window, max_ratio, slots):
+        self.window = window
+        self.max_ratio = max_ratio
+        self.slots = slots
+        self._latencies = {}  # método -> deque de segundos
+        self._credit = 1.0
+        self._lock = threading.Lock()
+        self.inflight = 0
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.skipped = 0
+        self.bypassed = 0
+
+    def acquire_slot(self):
+        """Reserva uma thread livre do executor; False se todas estão ocupadas (nada fica na fila)"""
+        with self._lock:
+            if self.inflight >= self.slots:
+                return False
+            self.inflight += 1
+            return True
+
+    def release_slot(self):
+        with self._lock:
+            self.inflight -= 1
+
+    def record_bypass(self):
+        with self._lock:
+            self.bypassed += 1
+
+    def record(self, method, seconds):
+        with self._lock:
+            samples = self._latencies.get(method)
+            if samples is None:
+                samples = self._latencies[method] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def delay(self, method):
+        """Quanto esperar o primário antes do hedge (p90 das latências recentes)"""
+        with self._lock:
+            self.calls += 1
+            self._credit = min(self._credit + self.max_ratio, 10.0)
+            samples = self._latencies.get(method)
+            if not samples or len(samples) < YTMUSIC_HEDGE_MIN_SAMPLES:
+                return YTMUSIC_HEDGE_DEFAULT_DELAY
+            ordered = sorted(samples)
+            return max(ordered[int(len(ordered) * 0.9)], YTMUSIC_HEDGE_MIN_DELAY)
+
+    def allow_hedge(self):
+        with self._lock:
+            if self._credit < 1:
+                self.skipped += 1
+                return False
+            self._credit -= 1
+            self.hedges += 1
+            return True
+
+    def record_win(self):
+        with self._lock:
+            self.hedge_wins += 1
+
+    def stats(self):
+        with self._lock:
+            p90 = {}
+            for method, samples in self._latencies.items():
+                ordered = sorted(samples)
+                p90[method] = round(ordered[int(len(ordered) * 0.9)], 3)
+            return {
+                'calls': self.calls,
+                'hedges': self.hedges,
+                'hedge_wins': self.hedge_wins,
+                'skipped_by_rate_cap': self.skipped,
+                'bypassed_executor_full': self.bypassed,
+                'inflight': self.inflight,
+                'workers': self.slots,
+                'p90': p90,
+            }
+
+ytmusic_hedge = HedgeController(YTMUSIC_HEDGE_WINDOW, YTMUSIC_HEDGE_MAX_RATIO, YTMUSIC_HEDGE_WORKERS)
+ytmusic_hedge_executor = ThreadPoolExecutor(max_workers=YTMUSIC_HEDGE_WORKERS, thread_name_prefix='ytmusic-hedge')
+
+def hedged_ytmusic_call(method, func, use_fallback=True):
+    """call_ytmusic com hedge para os métodos de YTMUSIC_HEDGE_METHODS"""
+    if (not YTMUSIC_HEDGE_ENABLED or method not in YTMUSIC_HEDGE_METHODS
+            or not ytmusic_auth_pool or not ytmusic_public_pool or oauth_breaker.state != 'closed'):
+        return call_ytmusic(func, use_fallback)
+
+    # As threads do executor não têm a requisição: a prioridade vai junto
+    priority = current_upstream_priority()
+
+    def in_worker(fn):
+        _upstream_priority.value = priority
+        try:
+            return fn()
+        finally:
+            _upstream_priority.value = None
+            ytmusic_hedge.release_slot()
+
+    def primary_call():
+        started = time.time()
+        result = call_ytmusic(func, use_fallback)
+        ytmusic_hedge.record(method, time.time() - started)
+        return result
+
+    # Só submete com thread livre: o tempo de fila não pode contar para o p90 (nem atrasar o player)
+    if not ytmusic_hedge.acquire_slot():
+        ytmusic_hedge.record_bypass()
+        return call_ytmusic(func, use_fallback)
+    primary = ytmusic_hedge_executor.submit(in_worker, primary_call)
+    done, _ = wait([primary], timeout=ytmusic_hedge.delay(method))
+    if done or not ytmusic_hedge.acquire_slot():
+        return primary.result()
+    if not ytmusic_hedge.allow_hedge():
+        ytmusic_hedge.release_slot()
+        return primary.result()
+
+    hedge = ytmusic_hedge_executor.submit(in_worker, lambda: ytmusic_public_pool.run(func))
+    pending = {primary, hedge}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is hedge:
+                    ytmusic_hedge.record_win()
+                return future.result()
+    return primary.result()  # Os dois falharam: erro do primário
+
+def create_svg_placeholder():
+    """Cria um SVG placeholder inline (nunca causa CORB)"""
+    svg = '''<svg xmlns="http://www.w3.org/2000/svg" width="160" height="160" viewBox="0 0 160 160">
+        <defs>
+            <linearGradient id="grad" x1="0%" y1="0%" x2="100%" y2="100%">
+                <stop offset="0%" style="stop-color:rgb(6,182,212);stop-opacity:0.2" />
+                <stop offset="100%" style="stop-color:rgb(59,130,246);stop-opacity:0.2" />
+            </linearGradient>
+        </defs>
+        <rect width="160" height="160" fill="url(#grad)"/>
+        <text x="80" y="80" font-family="Arial" font-size="48" fill="rgba(255,255,255,0.3)" text-anchor="middle" dominant-baseline="middle">[Musica]</text>
+    </svg>'''
+    
+    return Response(
+        svg,
+        mimetype='image/svg+xml',
+        headers={
+            'Access-Control-Allow-Origin': '*',
+            'Cache-Control': 'public, max-age=86400',
+            'Content-Type': 'image/svg+xml'
+        }
+    )
+
+# ========================================
+# CACHE NEGATIVO (URLs que falharam)
+# ========================================
+# URL quebrada conhecida devolve o placeholder na hora, sem prender uma thread por 5s
+NEGATIVE_CACHE_MAX_ENTRIES = 5000
+NEGATIVE_CACHE_TTLS = {
+    404: 3600,       # Não existe: improvável que apareça logo
+    410: 3600,
+    403: 600,
+    429: 30,         # Rate limit: tentar de novo logo
+    'status': 300,   # Outros status != 200
+    'server': 60,    # 5xx
+    'timeout': 30,   # Pode ter sido só lentidão momentânea
+    'network': 60,
+    'error': 60,
+}
+
+class NegativeImageCache:
+    """Lembra URLs de imagem que falharam, com TTL curto que depende do tipo de falha"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._items = OrderedDict()  # chave -> (expira_em, motivo)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.added = 0
+
+    def add(self, key, reason):
+        """Registra a falha e retorna o TTL aplicado (segundos)"""
+        if isinstance(reason, int):
+            if reason in NEGATIVE_CACHE_TTLS:
+                ttl = NEGATIVE_CACHE_TTLS[reason]
+            elif reason >= 500:
+                ttl = NEGATIVE_CACHE_TTLS['server']
+            else:
+                ttl = NEGATIVE_CACHE_TTLS['status']
+        else:
+            ttl = NEGATIVE_CACHE_TTLS.get(reason, NEGATIVE_CACHE_TTLS['error'])
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (time.time() + ttl, reason)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+            self.added += 1
+        return ttl
+
+    def lookup(self, key):
+        """Retorna (motivo, segundos restantes) se a URL ainda é conhecida como quebrada"""
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                return None
+            expires_at, reason = entry
+            remaining = expires_at - time.time()
+            if remaining <= 0:
+                del self._items[key]
+                return None
+            self.hits += 1
+            return reason, remaining
+
+    def get(self, key):
+        """Retorna o motivo da falha se a URL ainda é conhecida como quebrada"""
+        entry = self.lookup(key)
+        return entry[0] if entry else None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._items),
+                'hits': self.hits,
+                'added': self.added,
+            }
+
+image_negative_cache = NegativeImageCache(NEGATIVE_CACHE_MAX_ENTRIES)
+
+def failure_placeholder(max_age):
+    """Placeholder de falha: o navegador só guarda enquanto o cache negativo guardaria"""
+    response = create_svg_placeholder()
+    max_age = int(max_age)
+    response.headers['Cache-Control'] = f'public, max-age={max_age}' if max_age > 0 else 'no-store'
+    return response
+
+def negative_placeholder(reason, max_age):
+    """Placeholder servido para URL que está no cache negativo"""
+    response = failure_placeholder(max_age)
+    response.headers['X-Cache'] = f'NEGATIVE-{reason}'
+    return response
+
+# Downloads concorrentes da MESMA imagem viram um único request upstream
+image_fetch_flights = SingleFlight('image-proxy')
+IMAGE_FETCH_WAIT_TIMEOUT = 15  # Máximo que um seguidor espera o líder
+
+# Streaming: repassa a imagem ao cliente conforme chega, sem esperar o download inteiro
+IMAGE_PROXY_STREAMING = os.getenv('IMAGE_PROXY_STREAMING', '1') == '1'
+IMAGE_STREAM_CHUNK_SIZE = 16 * 1024
+
+# Headers para simular navegador e evitar bloqueio
+IMAGE_UPSTREAM_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8',
+    'Accept-Language': 'pt-BR,pt;q=0.9,en-US;q=0.8,en;q=0.7',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Referer': 'https://music.youtube.com/',
+    'Connection': 'keep-alive'
+}
+
+# ========================================
+# SESSÃO HTTP COMPARTILHADA (keep-alive + retry)
+# ========================================
+# Uma única sessão com pool de conexões por host: evita pagar TCP+TLS a cada imagem
+IMAGE_HTTP_POOL_HOSTS = 10  # Quantos hosts manter com pool aberto
+IMAGE_HTTP_POOL_MAXSIZE = int(os.getenv('IMAGE_HTTP_POOL_MAXSIZE', 16))  # Conexões por host
+IMAGE_HTTP_RETRIES = 2
+IMAGE_HTTP_BACKOFF = 0.3  # 0.3s, 0.6s... (+ jitter)
+IMAGE_HTTP_RETRY_AFTER_MAX = 2  # Nunca segurar a thread mais que isso por causa de Retry-After
+
+class ImageRetry(Retry):
+    """Retry do urllib3 com Retry-After limitado e contagem de tentativas"""
+
+    retries_count = 0
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, IMAGE_HTTP_RETRY_AFTER_MAX)
+
+    def increment(self, *args, **kwargs):
+        ImageRetry.retries_count += 1
+        return super().increment(*args, **kwargs)
+
+def create_image_session():
+    """Cria a sessão compartilhada usada por TODOS os downloads de imagem"""
+    retry_options = dict(
+        total=IMAGE_HTTP_RETRIES,
+        backoff_factor=IMAGE_HTTP_BACKOFF,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(['GET']),
+        respect_retry_after_header=True,
+        raise_on_status=False,  # Após esgotar, devolve a última resposta (vira ImageFetchError)
+    )
+    try:
+        retry = ImageRetry(backoff_jitter=IMAGE_HTTP_BACKOFF, **retry_options)
+    except TypeError:
+        retry = ImageRetry(**retry_options)  # urllib3 < 2 não tem jitter
+    adapter = HTTPAdapter(
+        pool_connections=IMAGE_HTTP_POOL_HOSTS,
+        pool_maxsize=IMAGE_HTTP_POOL_MAXSIZE,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.headers.update(IMAGE_UPSTREAM_HEADERS)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+image_http = create_image_session()
+image_http_requests = 0
+
+def image_http_get(url, timeout, headers=None):
+    """GET de imagem pela sessão compartilhada"""
+    global image_http_requests
+    upstream_limiter.acquire(urlsplit(url).hostname)
+    image_http_requests += 1
+    return image_http.get(url, timeout=timeout, headers=headers, stream=True)
+
+def image_http_stats():
+    """Uso dos pools de conexão por host"""
+    hosts = {}
+    for adapter in set(image_http.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for pool_key in list(pools.keys()):
+            pool = pools.get(pool_key)
+            if pool is None:
+                continue
+            hosts[pool.host] = {
+                'connections_opened': pool.num_connections,
+                'requests': pool.num_requests,
+                'idle': pool.pool.qsize() if pool.pool else 0,
+            }
+    return {
+        'requests': image_http_requests,
+        'retries': ImageRetry.retries_count,
+        'pool_maxsize': IMAGE_HTTP_POOL_MAXSIZE,
+        'hosts': hosts,
+    }
+
+class ImageFetchError(Exception):
+    """Upstream respondeu com status diferente de 200"""
+
+    def __init__(self, status_code):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+def normalize_image_url(url):
+    """Normaliza a URL (espaços, esquema/host em minúsculas) para usar como chave"""
+    url = url.strip()
+    parts = urlsplit(url)
+    if not parts.scheme or not parts.netloc:
+        return url
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ''))
+
+def guess_image_content_type(response, image_url):
+    """Determina o Content-Type correto (prioriza o header da resposta)"""
+    content_type = response.headers.get('Content-Type', 'image/jpeg')
+    
+    # Se não tem Content-Type ou é incorreto, deduz pela URL
+    if not content_type or content_type == 'application/octet-stream':
+        if '.png' in image_url.lower():
+            content_type = 'image/png'
+        elif '.webp' in image_url.lower():
+            content_type = 'image/webp'
+        elif '.gif' in image_url.lower():
+            content_type = 'image/gif'
+        else:
+            content_type = 'image/jpeg'
+    return content_type
+
+def store_image(cache_key, content, content_type, upstream_headers=None, **extra):
+    """Salva a imagem nos dois níveis de cache (memória e disco) e retorna o resultado com validadores"""
+    upstream_headers = upstream_headers or {}
+    digest = hashlib.sha256(content).hexdigest()
+    validators = {
+        'etag': image_etag(digest),
+        'last_modified': upstream_headers.get('Last-Modified') or http_date(time.time()),
+        # Guardados para revalidar no upstream quando a cópia em disco envelhecer
+        'upstream_etag': upstream_headers.get('ETag'),
+        'upstream_last_modified': upstream_headers.get('Last-Modified'),
+    }
+    validators.update(extra)
+    # LRU remove as menos usadas se passar do orçamento
+    if image_cache.set(cache_key, content, content_type, **validators):
+        stats = image_cache.stats()
+        print(f"[CACHE] Imagem adicionada ao cache ({stats['bytes'] // 1024}KB/{IMAGE_CACHE_MAX_BYTES // 1024}KB)")
+    if image_disk_cache:
+        image_disk_cache.set(cache_key, content, content_type, digest=digest, **validators)
+    result = {'content': content, 'content_type': content_type}
+    result.update(validators)
+    return result
+
+def open_upstream_image(image_url, validators=None):
+    """Abre a conexão com o upstream (sem ler o corpo). Retorna (response, content_type).
+    
+    Com validators (If-None-Match / If-Modified-Since), um 304 do upstream volta
+    como (response, None).
+    """
+    # Faz a requisição da imagem com timeout REDUZIDO (5s ao invés de 15s)
+    response = image_http_get(image_url, timeout=5, headers=validators)
+    
+    if validators and response.status_code == 304:
+        response.close()
+        return response, None
+    
+    # Verifica se foi bem-sucedido
+    if response.status_code != 200:
+        response.close()
+        # Fallback: Se maxresdefault.jpg falhar (404), tentar sddefault.jpg
+        if response.status_code == 404 and 'maxresdefault.jpg' in image_url:
+            print(f"[Retry] maxresdefault 404, tentando sddefault: {image_url[:60]}...")
+            fallback_url = image_url.replace('maxresdefault.jpg', 'sddefault.jpg')
+            try:
+                fallback_response = image_http_get(fallback_url, timeout=10)
+                if fallback_response.status_code == 200:
+                    print(f"[OK] Fallback bem-sucedido: sddefault.jpg")
+                    return fallback_response, 'image/jpeg'
+                fallback_response.close()
+            except requests.exceptions.RequestException:
+                pass
+        
+        raise ImageFetchError(response.status_code)
+    
+    content_type = guess_image_content_type(response, image_url)
+    
+    # Log de sucesso
+    print(f"[OK] Imagem carregada: {content_type} - {image_url[:60]}...")
+    return response, content_type
 
-# ========================================
-# CACHE DE IMAGENS (LRU)
-# ========================================
-# Cache para armazenar imagens em memória (reduz requisições repetidas)
-image_cache = {}
-IMAGE_CACHE_MAX_SIZE = 200  # Máximo de 200 imagens em cache
-IMAGE_CACHE_TTL = 3600  # 1 hora de TTL
+def fetch_upstream_image(image_url, cache_key):
+    """Baixa a imagem inteira do upstream e salva no cache. Levanta ImageFetchError se falhar."""
+    upstream, content_type = open_upstream_image(image_url)
+    
+    # ==== CACHE: Salvar imagem no cache ====
+    return store_image(cache_key, upstream.content, content_type, upstream.headers)
 
-def safe_ytmusic_call(func, *args, use_fallback=True, **kwargs):
+def revalidate_upstream_image(image_url, cache_key, meta):
+    """Revalida no upstream uma cópia em disco vencida.
+    
+    Retorna None se o upstream confirmou que não mudou (304), ou o novo
+    resultado já salvo no cache se mudou.
     """
-    Executa uma chamada do ytmusicapi com fallback automático.
-    Se OAuth der 403, tenta com yt_public.
+    validators = {}
+    if meta.get('upstream_etag'):
+        validators['If-None-Match'] = meta['upstream_etag']
+    if meta.get('upstream_last_modified'):
+        validators['If-Modified-Since'] = meta['upstream_last_modified']
+    
+    upstream, content_type = open_upstream_image(image_url, validators or None)
+    if content_type is None:
+        print(f"[CACHE] Upstream confirmou (304), renovando cópia em disco: {image_url[:60]}...")
+        image_disk_cache.refresh(cache_key)
+        return None
+    return store_image(cache_key, upstream.content, content_type, upstream.headers)
+
+def stream_upstream_image(upstream, content_type, cache_key, on_done):
+    """Repassa os chunks do upstream ao cliente enquanto guarda uma cópia para o cache.
+    
+    Passando de IMAGE_CACHE_MAX_ITEM_BYTES a imagem continua sendo enviada, mas a
+    cópia é descartada (memória por request fica limitada). on_done(result) é chamado
+    no final com o resultado cacheável, ou None se a imagem não foi cacheada.
     """
+    buffer = bytearray()
+    completed = False
     try:
-        # Tentar primeiro com yt (OAuth se disponível)
-        if yt:
-            return func(yt, *args, **kwargs)
-        elif yt_public:
-            return func(yt_public, *args, **kwargs)
-        else:
-            raise Exception("YTMusic não disponível")
-    except Exception as e:
-        error_msg = str(e)
-        # Se for 403 e tivermos fallback público, tentar com ele
-        if use_fallback and "403" in error_msg and yt_public and yt != yt_public:
-            print(f"[AVISO] OAuth deu 403, tentando com modo público...")
-            try:
-                return func(yt_public, *args, **kwargs)
-            except Exception as e2:
-                print(f"[ERRO] Fallback público também falhou: {e2}")
-                raise e  # Lançar erro original
-        else:
-            raise
+        for chunk in upstream.iter_content(IMAGE_STREAM_CHUNK_SIZE):
+            if buffer is not None:
+                buffer.extend(chunk)
+                if len(buffer) > IMAGE_CACHE_MAX_ITEM_BYTES:
+                    print(f"[STREAM] Imagem grande demais para o cache, apenas repassando...")
+                    buffer = None
+            yield chunk
+        completed = True
+    finally:
+        upstream.close()
+        result = None
+        if completed and buffer is not None:
+            result = store_image(cache_key, bytes(buffer), content_type, upstream.headers)
+        on_done(result)
 
-def create_svg_placeholder():
-    """Cria um SVG placeholder inline (nunca causa CORB)"""
-    svg = '''<svg xmlns="http://www.w3.org/2000/svg" width="160" height="160" viewBox="0 0 160 160">
-        <defs>
-            <linearGradient id="grad" x1="0%" y1="0%" x2="100%" y2="100%">
-                <stop offset="0%" style="stop-color:rgb(6,182,212);stop-opacity:0.2" />
-                <stop offset="100%" style="stop-color:rgb(59,130,246);stop-opacity:0.2" />
-            </linearGradient>
-        </defs>
-        <rect width="160" height="160" fill="url(#grad)"/>
-        <text x="80" y="80" font-family="Arial" font-size="48" fill="rgba(255,255,255,0.3)" text-anchor="middle" dominant-baseline="middle">[Musica]</text>
-    </svg>'''
+def streaming_image_response(upstream, content_type, cache_key, cache_status, on_done=None):
+    """Response que envia a imagem conforme chega do upstream (TTFB = primeiro chunk)"""
+    on_done = on_done or (lambda result: None)
+    response = Response(
+        stream_with_context(stream_upstream_image(upstream, content_type, cache_key, on_done)),
+        mimetype=content_type,
+        # ETag só existe quando o conteúdo inteiro passar; Last-Modified do upstream já dá para repassar
+        headers=image_response_headers(content_type, cache_status, last_modified=upstream.headers.get('Last-Modified'))
+    )
+    # Se o corpo nunca for consumido (cliente desconectou antes), liberar seguidores mesmo assim
+    response.call_on_close(lambda: on_done(None))
+    response.call_on_close(upstream.close)
+    return response
+
+# ========================================
+# TRANSCODIFICAÇÃO WEBP/AVIF (derivados)
+# ========================================
+# Recodifica em processos separados (nunca na thread do request): o primeiro
+# request recebe o original e agenda o derivado; os próximos já recebem WebP/AVIF.
+IMAGE_TRANSCODE_FORMATS = image_transcoder.supported_formats() if os.getenv('IMAGE_TRANSCODE', '1') == '1' else set()
+IMAGE_TRANSCODE_WORKERS = int(os.getenv('IMAGE_TRANSCODE_WORKERS', 1))
+IMAGE_TRANSCODE_MAX_PENDING = 32  # Mais que isso na fila: servir o original e não agendar
+IMAGE_TRANSCODE_QUALITY = {'webp': 80, 'avif': 60}
+IMAGE_TRANSCODE_SOURCE_TYPES = ('image/jpeg', 'image/png')
+
+image_transcode_pool = None
+image_transcode_pending = set()
+image_transcode_lock = threading.Lock()
+image_transcode_counts = {'scheduled': 0, 'done': 0, 'not_smaller': 0, 'skipped': 0, 'failed': 0}
+
+if IMAGE_TRANSCODE_FORMATS:
+    print(f"[OK] Transcodificação de imagens: {', '.join(sorted(IMAGE_TRANSCODE_FORMATS))}")
+
+def negotiate_image_format():
+    """Melhor formato derivado aceito pelo navegador (Accept), ou None"""
+    accept = request.headers.get('Accept', '')
+    for fmt in ('avif', 'webp'):
+        if fmt in IMAGE_TRANSCODE_FORMATS and image_transcoder.IMAGE_FORMATS[fmt] in accept:
+            return fmt
+    return None
+
+def get_image_pool():
+    """Pool de processos para trabalho pesado com imagens (criado sob demanda)"""
+    global image_transcode_pool
+    with image_transcode_lock:
+        if image_transcode_pool is None:
+            # spawn: fork com threads é arriscado. Sob gunicorn os filhos importam só o
+            # image_transcoder; com `python app.py` reexecutam este arquivo (ver SPAWNED_CHILD)
+            image_transcode_pool = ProcessPoolExecutor(
+                max_workers=IMAGE_TRANSCODE_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return image_transcode_pool
+
+def discard_image_pool(pool):
+    """Um filho morreu (OOM, crash do Pillow): descarta o pool para o próximo uso criar outro"""
+    global image_transcode_pool
+    with image_transcode_lock:
+        if image_transcode_pool is not pool:
+            return  # Outra thread já trocou
+        image_transcode_pool = None
+    pool.shutdown(wait=False)
+    print("[TRANSCODE] Pool de processos quebrado, será recriado no próximo uso")
+
+def schedule_image_transcode(derivative_key, source, content_type, fmt):
+    """Agenda a geração do derivado no pool de processos (sem esperar)"""
+    if content_type not in IMAGE_TRANSCODE_SOURCE_TYPES:
+        return
+    with image_transcode_lock:
+        if derivative_key in image_transcode_pending:
+            return
+        if len(image_transcode_pending) >= IMAGE_TRANSCODE_MAX_PENDING:
+            image_transcode_counts['skipped'] += 1
+            return
+        image_transcode_pending.add(derivative_key)
+        image_transcode_counts['scheduled'] += 1
     
+    pool = get_image_pool()
+    
+    def on_done(future):
+        with image_transcode_lock:
+            image_transcode_pending.discard(derivative_key)
+        try:
+            content = future.result()
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                discard_image_pool(pool)
+            print(f"[TRANSCODE] Falha ao gerar {fmt}: {type(e).__name__}: {e}")
+            with image_transcode_lock:
+                image_transcode_counts['failed'] += 1
+            return
+        if content is None:
+            # Não ficou menor: o "derivado" é o próprio original (evita reagendar sempre)
+            with image_transcode_lock:
+                image_transcode_counts['not_smaller'] += 1
+            original = source if isinstance(source, bytes) else None
+            if original is None:
+                try:
+                    with open(source, 'rb') as f:
+                        original = f.read()
+                except OSError:
+                    return
+            store_image(derivative_key, original, content_type)
+            return
+        with image_transcode_lock:
+            image_transcode_counts['done'] += 1
+        store_image(derivative_key, content, image_transcoder.IMAGE_FORMATS[fmt])
+    
+    try:
+        future = pool.submit(image_transcoder.transcode_image, source, fmt, IMAGE_TRANSCODE_QUALITY[fmt])
+    except RuntimeError as e:
+        # Pool quebrado/encerrado: desistir sem afetar o request
+        print(f"[TRANSCODE] Pool indisponível: {e}")
+        if isinstance(e, BrokenProcessPool):
+            discard_image_pool(pool)
+        with image_transcode_lock:
+            image_transcode_pending.discard(derivative_key)
+            image_transcode_counts['failed'] += 1
+        return
+    future.add_done_callback(on_done)
+
+def image_transcode_stats():
+    with image_transcode_lock:
+        stats = dict(image_transcode_counts)
+        stats['pending'] = len(image_transcode_pending)
+    stats['formats'] = sorted(IMAGE_TRANSCODE_FORMATS)
+    return stats
+
+def memory_image_response(entry, cache_status):
+    """Response (ou 304) para uma imagem do cache em memória"""
+    etag, last_modified = entry.get('etag'), entry.get('last_modified')
+    if client_has_image(etag, last_modified):
+        return image_not_modified_response(entry['content_type'], etag, last_modified, cache_status)
     return Response(
-        svg,
-        mimetype='image/svg+xml',
-        headers={
-            'Access-Control-Allow-Origin': '*',
-            'Cache-Control': 'public, max-age=86400',
-            'Content-Type': 'image/svg+xml'
-        }
+        entry['content'],
+        mimetype=entry['content_type'],
+        headers=image_response_headers(entry['content_type'], cache_status, etag, last_modified)
     )
 
+def disk_image_response(meta, cache_status):
+    """Response (ou 304) para uma imagem do cache em disco, via sendfile. None se o blob sumiu."""
+    etag = meta.get('etag') or image_etag(meta['digest'])
+    last_modified = meta.get('last_modified')
+    if client_has_image(etag, last_modified):
+        return image_not_modified_response(meta['content_type'], etag, last_modified, cache_status)
+    disk_file = image_disk_cache.open_blob(meta)
+    if not disk_file:
+        return None
+    response = send_file(disk_file, mimetype=meta['content_type'], conditional=False, etag=False)
+    response.headers.update(image_response_headers(meta['content_type'], cache_status, etag, last_modified))
+    response.content_length = meta['size']
+    return response
+
 @app.route('/api/image-proxy', methods=['GET', 'OPTIONS'])
 def image_proxy():
     """Proxy para imagens externas (resolve CORB e CORS) - COM CACHE"""
@@ -276,134 +2310,184 @@ def image_proxy():
         # Retorna SVG placeholder inline (nunca causa CORB)
         return create_svg_placeholder()
     
+    # ==== TAMANHO: bucket pelo contexto do template (w) + client hints ====
+    vary = ['Origin']
+    if is_resizable_image_url(image_url):
+        size_bucket = requested_image_bucket(request.args.get('w', type=int))
+        if size_bucket:
+            # URL (e portanto a chave do cache) já inclui o bucket
+            image_url = resize_image_url(image_url, size_bucket)
+        vary.append(IMAGE_CLIENT_HINTS_VARY)
+    
+    # ==== FORMATO: WebP/AVIF se o navegador aceitar ====
+    target_format = None
+    if IMAGE_TRANSCODE_FORMATS and is_known_image_host(image_url):
+        target_format = negotiate_image_format()
+        vary.append('Accept')
+    
+    if len(vary) > 1:
+        @after_this_request
+        def add_vary(response):
+            response.headers['Vary'] = ', '.join(vary)
+            return response
+    
     # ==== CACHE: Verificar se imagem já está no cache ====
-    cache_key = image_url
-    if cache_key in image_cache:
-        cached_data = image_cache[cache_key]
-        # Verificar se cache ainda é válido (TTL)
-        if datetime.now().timestamp() - cached_data['timestamp'] < IMAGE_CACHE_TTL:
-            print(f"[CACHE] Imagem recuperada do cache: {image_url[:60]}...")
-            return Response(
-                cached_data['content'],
-                mimetype=cached_data['content_type'],
-                headers={
-                    'Access-Control-Allow-Origin': '*',
-                    'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                    'Access-Control-Allow-Headers': 'Content-Type',
-                    'Cache-Control': 'public, max-age=86400',
-                    'X-Content-Type-Options': 'nosniff',
-                    'Content-Type': cached_data['content_type'],
-                    'Vary': 'Origin',
-                    'X-Cache': 'HIT'  # Indica que veio do cache
-                }
-            )
-        else:
-            # Cache expirado, remover
-            del image_cache[cache_key]
+    cache_key = normalize_image_url(image_url)
+    derivative_key = f'{cache_key}#{target_format}' if target_format else None
     
-    try:
-        # Headers para simular navegador e evitar bloqueio
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Accept': 'image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8',
-            'Accept-Language': 'pt-BR,pt;q=0.9,en-US;q=0.8,en;q=0.7',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Referer': 'https://music.youtube.com/',
-            'Connection': 'keep-alive'
-        }
-        
-        # Faz a requisição da imagem com timeout REDUZIDO (5s ao invés de 15s)
-        response = requests.get(image_url, headers=headers, timeout=5, stream=True)
+    def queue_derivative(source, content_type):
+        """Original servido, mas o navegador aceita WebP/AVIF: gerar para os próximos"""
+        if derivative_key:
+            schedule_image_transcode(derivative_key, source, content_type, target_format)
+    
+    # ==== DERIVADO (WebP/AVIF) já pronto? ====
+    if derivative_key:
+        cached_data = image_cache.get(derivative_key)
+        if cached_data:
+            return memory_image_response(cached_data, 'HIT')
+        disk_meta = image_disk_cache.get(derivative_key) if image_disk_cache else None
+        if disk_meta:
+            response = disk_image_response(disk_meta, 'HIT-DISK')
+            if response:
+                return response
+    
+    cached_data = image_cache.get(cache_key)
+    if cached_data:
+        print(f"[CACHE] Imagem recuperada do cache: {image_url[:60]}...")
+        queue_derivative(cached_data['content'], cached_data['content_type'])
+        return memory_image_response(cached_data, 'HIT')
+    
+    # ==== CACHE EM DISCO: compartilhado entre workers, enviado via sendfile ====
+    disk_meta = image_disk_cache.get(cache_key, allow_stale=True) if image_disk_cache else None
+    if disk_meta:
+        cache_status = 'HIT-DISK'
+        if disk_meta['stale']:
+            # Cópia vencida: revalidar no upstream (If-None-Match) em vez de baixar de novo
+            try:
+                result = image_fetch_flights.do(
+                    'revalidate:' + cache_key,
+                    lambda: revalidate_upstream_image(image_url, cache_key, disk_meta),
+                    IMAGE_FETCH_WAIT_TIMEOUT
+                )
+            except Exception as e:
+                # Upstream com problema: servir a cópia antiga é melhor que o placeholder
+                print(f"[CACHE] Revalidação falhou ({type(e).__name__}), servindo cópia antiga...")
+                result = None
+            if result:
+                queue_derivative(result['content'], result['content_type'])
+                return Response(
+                    result['content'],
+                    mimetype=result['content_type'],
+                    headers=image_response_headers(result['content_type'], 'MISS', result['etag'], result['last_modified'])
+                )
+            cache_status = 'REVALIDATED'
         
-        # Verifica se foi bem-sucedido
-        if response.status_code != 200:
-            # Fallback: Se maxresdefault.jpg falhar (404), tentar sddefault.jpg
-            if response.status_code == 404 and 'maxresdefault.jpg' in image_url:
-                print(f"[Retry] maxresdefault 404, tentando sddefault: {image_url[:60]}...")
-                fallback_url = image_url.replace('maxresdefault.jpg', 'sddefault.jpg')
+        response = disk_image_response(disk_meta, cache_status)
+        if response:
+            print(f"[CACHE] Imagem recuperada do disco: {image_url[:60]}...")
+            queue_derivative(disk_meta['path'], disk_meta['content_type'])
+            return response
+    
+    # ==== CACHE NEGATIVO: URL falhou há pouco, nem tentar de novo ====
+    negative = image_negative_cache.lookup(cache_key)
+    if negative is not None:
+        return negative_placeholder(*negative)
+    
+    try:
+        # ==== SINGLE-FLIGHT: só o primeiro miss baixa, os demais esperam o resultado ====
+        call, is_leader = image_fetch_flights.begin(cache_key)
+        if is_leader:
+            if IMAGE_PROXY_STREAMING:
                 try:
-                    fallback_response = requests.get(fallback_url, headers=headers, timeout=10, stream=True)
-                    if fallback_response.status_code == 200:
-                        print(f"[OK] Fallback bem-sucedido: sddefault.jpg")
-                        return Response(
-                            fallback_response.content,
-                            mimetype='image/jpeg',
-                            headers={
-                                'Access-Control-Allow-Origin': '*',
-                                'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                                'Cache-Control': 'public, max-age=86400',
-                                'Content-Type': 'image/jpeg',
-                                'X-Content-Type-Options': 'nosniff',
-                                'Vary': 'Origin'
-                            }
-                        )
-                except:
-                    pass
-            
-            print(f"[AVISO] Imagem falhou com status {response.status_code}: {image_url[:60]}...")
-            return create_svg_placeholder()
-        
-        # Determina o Content-Type correto (prioriza o header da resposta)
-        content_type = response.headers.get('Content-Type', 'image/jpeg')
-        
-        # Se não tem Content-Type ou é incorreto, deduz pela URL
-        if not content_type or content_type == 'application/octet-stream':
-            if '.png' in image_url.lower():
-                content_type = 'image/png'
-            elif '.webp' in image_url.lower():
-                content_type = 'image/webp'
-            elif '.gif' in image_url.lower():
-                content_type = 'image/gif'
-            else:
-                content_type = 'image/jpeg'
-        
-        # Log de sucesso
-        print(f"[OK] Imagem carregada: {content_type} - {image_url[:60]}...")
-        
-        # ==== CACHE: Salvar imagem no cache ====
-        image_content = response.content
-        
-        # Limitar tamanho do cache (FIFO - remover mais antigo se estiver cheio)
-        if len(image_cache) >= IMAGE_CACHE_MAX_SIZE:
-            # Remover o item mais antigo (primeira chave)
-            oldest_key = next(iter(image_cache))
-            del image_cache[oldest_key]
-            print(f"[CACHE] Cache cheio, removendo item mais antigo")
-        
-        # Adicionar ao cache
-        image_cache[cache_key] = {
-            'content': image_content,
-            'content_type': content_type,
-            'timestamp': datetime.now().timestamp()
-        }
-        print(f"[CACHE] Imagem adicionada ao cache ({len(image_cache)}/{IMAGE_CACHE_MAX_SIZE})")
+                    upstream, content_type = open_upstream_image(image_url)
+                except BaseException as e:
+                    image_fetch_flights.finish(cache_key, call, error=e)
+                    raise
+                def on_stream_done(result):
+                    image_fetch_flights.finish(cache_key, call, result=result)
+                    if result:
+                        queue_derivative(result['content'], result['content_type'])
+                
+                # O líder só é concluído quando o stream termina
+                return streaming_image_response(upstream, content_type, cache_key, 'MISS-STREAM', on_done=on_stream_done)
+            try:
+                result = fetch_upstream_image(image_url, cache_key)
+            except BaseException as e:
+                image_fetch_flights.finish(cache_key, call, error=e)
+                raise
+            image_fetch_flights.finish(cache_key, call, result=result)
+            cache_status = 'MISS'  # Baixado (não estava no cache)
+        else:
+            try:
+                result = image_fetch_flights.wait(call, IMAGE_FETCH_WAIT_TIMEOUT)
+            except TimeoutError:
+                # Líder em streaming só termina quando o cliente DELE lê tudo: não ficar preso a ele
+                print(f"[TIMEOUT] Download em andamento não terminou a tempo, baixando direto: {image_url[:60]}...")
+                result = None
+            cache_status = 'COALESCED'  # Reaproveitou download em andamento
+            if result is None:
+                # Líder não gerou cópia cacheável (imagem grande, stream abortado ou lento): baixar direto
+                upstream, content_type = open_upstream_image(image_url)
+                return streaming_image_response(upstream, content_type, cache_key, 'MISS-STREAM')
         
+        queue_derivative(result['content'], result['content_type'])
         # Retorna a imagem com headers CORRETOS para evitar CORB
         return Response(
-            image_content,
-            mimetype=content_type,
-            headers={
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Cache-Control': 'public, max-age=86400',
-                'X-Content-Type-Options': 'nosniff',
-                'Content-Type': content_type,  # Garantir Content-Type explícito
-                'Vary': 'Origin',
-                'X-Cache': 'MISS'  # Indica que foi baixado (não estava no cache)
-            }
+            result['content'],
+            mimetype=result['content_type'],
+            headers=image_response_headers(result['content_type'], cache_status, result['etag'], result['last_modified'])
         )
+    except ImageFetchError as e:
+        print(f"[AVISO] Imagem falhou com status {e.status_code}: {image_url[:60]}...")
+        return failure_placeholder(image_negative_cache.add(cache_key, e.status_code))
     except requests.exceptions.Timeout:
         print(f"[TIMEOUT] Imagem demorou mais de 5s para carregar: {image_url[:60]}...")
-        return create_svg_placeholder()
+        return failure_placeholder(image_negative_cache.add(cache_key, 'timeout'))
+    except TimeoutError:
+        print(f"[TIMEOUT] Imagem não terminou a tempo: {image_url[:60]}...")
+        return failure_placeholder(0)
+    except UpstreamRateLimited:
+        # Não vai para o cache negativo nem para o cache do navegador: a imagem existe
+        response = create_svg_placeholder()
+        response.headers['Cache-Control'] = 'no-store'
+        response.headers['X-Cache'] = 'SHED'
+        return response
     except requests.exceptions.RequestException as e:
         print(f"[Web] ERRO de rede ao carregar imagem: {type(e).__name__}")
         print(f"   URL que falhou: {image_url[:80]}")
-        return create_svg_placeholder()
+        return failure_placeholder(image_negative_cache.add(cache_key, 'network'))
     except Exception as e:
         print(f"[ERRO] ERRO DESCONHECIDO ao carregar imagem: {type(e).__name__}: {e}")
         print(f"   URL que falhou: {image_url[:60]}...")
-        return create_svg_placeholder()
+        return failure_placeholder(image_negative_cache.add(cache_key, 'error'))
+
+@app.route('/api/stats')
+def stats_endpoint():
+    """Estatísticas internas (caches) para monitoramento"""
+    return jsonify({
+        'success': True,
+        'image_cache': image_cache.stats(),
+        'image_disk_cache': image_disk_cache.stats() if image_disk_cache else None,
+        'image_fetch_flights': image_fetch_flights.stats(),
+        'image_http': image_http_stats(),
+        'image_negative_cache': image_negative_cache.stats(),
+        'image_transcode': image_transcode_stats(),
+        'ytmusic_cache': dict(ytmusic_cache.stats(), enabled=YTMUSIC_CACHE_ENABLED),
+        'fragment_cache': fragment_cache_stats(),
+        'ytmusic_flights': ytmusic_flights.stats(),
+        'oauth_breaker': oauth_breaker.stats(),
+        'ytmusic_hedge': ytmusic_hedge.stats(),
+        'search_executor': search_executor.stats(),
+        'search_store': search_store.stats(),
+        'suggestion_index': suggestion_index.stats(),
+        'catalog_index': catalog_index.stats(),
+        'upstream_rate_limit': upstream_limiter.stats(),
+        'oauth_token': oauth_token_refresher.stats() if oauth_token_refresher else None,
+        'ytmusic_pools': {
+            'oauth': ytmusic_auth_pool.stats() if ytmusic_auth_pool else None,
+            'public': ytmusic_public_pool.stats() if ytmusic_public_pool else None,
+        },
+    })
 
 @app.route('/')
 def index():
@@ -438,6 +2522,463 @@ def ensure_thumbnail(item):
     
     return item
 
+# ========================================
+# BUSCA: STORE DE RESULTADOS
+# ========================================
+# Uma entrada por (query normalizada, filtro) guardando a MAIOR página já buscada:
+# /api/search (limite 6/15) e a aba de /api/search-results-html (limite 20) usam a mesma.
+SEARCH_STORE_MAX_ENTRIES = 500
+SEARCH_STORE_TTL = YTMUSIC_CACHE_TTLS['search']
+YTMUSIC_SEARCH_PAGE_SIZE = 20  # O upstream sempre devolve a primeira página inteira, mesmo com limit menor
+
+def normalize_search_query(query):
+    """Chave da busca: Unicode NFKC, sem diferença de maiúsculas e espaços repetidos"""
+    return ' '.join(unicodedata.normalize('NFKC', query).casefold().split())
+
+class SearchResultStore:
+    """LRU (query normalizada, filtro) -> maior página de resultados"""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._items = OrderedDict()  # chave -> (timestamp, limite buscado, resultados)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.upgrades = 0  # Já tinha a query, mas com página menor que a pedida
+
+    def get(self, key, limit):
+        """Resultados que atendem limit, ou None (com o limite já buscado, para ampliar)"""
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None or time.time() - entry[0] >= self.ttl:
+                self._items.pop(key, None)
+                self.misses += 1
+                return None, 0
+            timestamp, fetched_limit, results = entry
+            # Já tem resultados suficientes, ou já pedimos pelo menos isso ao upstream
+            if len(results) >= limit or fetched_limit >= limit:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return results, fetched_limit
+            self.upgrades += 1
+            return None, fetched_limit
+
+    def set(self, key, limit, results):
+        with self._lock:
+            current = self._items.get(key)
+            if current is not None and current[1] > limit and time.time() - current[0] < self.ttl:
+                return  # Uma chamada concorrente já guardou uma página maior
+            self._items.pop(key, None)
+            self._items[key] = (time.time(), limit, results)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._items),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'upgrades': self.upgrades,
+            }
+
+search_store = SearchResultStore(SEARCH_STORE_MAX_ENTRIES, SEARCH_STORE_TTL)
+
+def search_results(query, filter_type, limit):
+    """Busca pelo store: reutiliza a maior página da mesma query/filtro e corta no limite"""
+    key = (normalize_search_query(query), filter_type or '')
+    suggestion_index.add(query, SUGGEST_WEIGHTS['query'] / len(SEARCH_CATEGORIES))  # Uma busca = 4 categorias
+    results, fetched_limit = search_store.get(key, limit)
+    if results is None:
+        fetch_limit = max(limit, fetched_limit)
+        # cache_ttl=0: o store substitui o cache por método para buscas
+        results = safe_ytmusic_call('search', query, filter=filter_type, limit=fetch_limit, cache_ttl=0)
+        search_store.set(key, fetch_limit, copy.deepcopy(results))
+        return results[:max(limit, YTMUSIC_SEARCH_PAGE_SIZE)]
+    return copy.deepcopy(results[:max(limit, YTMUSIC_SEARCH_PAGE_SIZE)])
+
+# ========================================
+# BUSCA: ÍNDICE DE SUGESTÕES (prefixo)
+# ========================================
+# Lista ordenada de termos + busca binária pelo prefixo. Alimentada pelas sugestões
+# do upstream, pelas buscas feitas e pelos títulos do que já foi buscado no YTMusic.
+SUGGEST_INDEX_MAX_TERMS = int(os.getenv('SUGGEST_INDEX_MAX_TERMS', 20000))
+SUGGEST_MAX_TERM_LENGTH = 80
+SUGGEST_RESULTS = 5
+SUGGEST_LOCAL_MIN = 5  # Candidatos locais necessários para não ir ao upstream
+SUGGEST_SCAN_LIMIT = 500  # Máximo de termos examinados por prefixo
+# Peso de cada fonte na popularidade
+SUGGEST_WEIGHTS = {'query': 3.0, 'upstream': 1.0, 'title': 0.5}
+
+def fold_search_text(text):
+    """normalize_search_query + sem acentos ('Vitória' -> 'vitoria')"""
+    decomposed = unicodedata.normalize('NFKD', normalize_search_query(text))
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+class SuggestionIndex:
+    """Índice de prefixos com ranking por popularidade e número máximo de termos"""
+
+    def __init__(self, max_terms):
+        self.max_terms = max_terms
+        self._keys = []  # Termos normalizados, ordenados
+        self._terms = {}  # termo -> [texto exibido, pontuação]
+        self._lock = threading.Lock()
+        self.local_hits = 0
+        self.upstream_fallbacks = 0
+        self.evicted = 0
+
+    def add(self, text, weight):
+        if not text or not isinstance(text, str):
+            return
+        text = ' '.join(text.split())[:SUGGEST_MAX_TERM_LENGTH]
+        key = fold_search_text(text)
+        if len(key) < 2:
+            return
+        with self._lock:
+            entry = self._terms.get(key)
+            if entry is not None:
+                entry[1] += weight
+                return
+            self._terms[key] = [text, weight]
+            bisect.insort(self._keys, key)
+            if len(self._keys) > self.max_terms:
+                self._evict()
+
+    def _evict(self):
+        """Remove os 10% menos populares de uma vez (evita reordenar a cada termo novo)"""
+        drop = max(1, self.max_terms // 10)
+        victims = set(sorted(self._terms, key=lambda k: self._terms[k][1])[:drop])
+        for key in victims:
+            del self._terms[key]
+        self._keys = [k for k in self._keys if k not in victims]
+        self.evicted += len(victims)
+
+    def lookup(self, prefix, limit=SUGGEST_RESULTS):
+        """Termos que começam com o prefixo, mais populares primeiro"""
+        prefix = fold_search_text(prefix)
+        with self._lock:
+            start = bisect.bisect_left(self._keys, prefix)
+            candidates = []
+            for key in itertools.islice(self._keys, start, start + SUGGEST_SCAN_LIMIT):
+                if not key.startswith(prefix):
+                    break
+                candidates.append(self._terms[key])
+        candidates.sort(key=lambda entry: entry[1], reverse=True)
+        return [text for text, _ in candidates[:limit]]
+
+    def record(self, source):
+        with self._lock:
+            if source == 'local':
+                self.local_hits += 1
+            else:
+                self.upstream_fallbacks += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'terms': len(self._keys),
+                'max_terms': self.max_terms,
+                'local_hits': self.local_hits,
+                'upstream_fallbacks': self.upstream_fallbacks,
+                'evicted': self.evicted,
+            }
+
+suggestion_index = SuggestionIndex(SUGGEST_INDEX_MAX_TERMS)
+
+def entity_titles(item):
+    """Títulos e nomes de artista de um resultado do ytmusicapi"""
+    if not isinstance(item, dict):
+        return []
+    titles = [item.get('title'), item.get('name'), item.get('artist')]
+    for artist in item.get('artists') or []:
+        if isinstance(artist, dict):
+            titles.append(artist.get('name'))
+    return [t for t in titles if isinstance(t, str)]
+
+def observe_ytmusic_result(method, args, result):
+    """Alimenta os índices locais com o que acabou de vir do upstream"""
+    try:
+        index_catalog_result(method, args, result)
+        if method == 'get_search_suggestions':
+            for suggestion in result or []:
+                suggestion_index.add(suggestion, SUGGEST_WEIGHTS['upstream'])
+            return
+        if method == 'search':
+            items = result or []
+        elif method in ('get_artist', 'get_album'):
+            items = [result]
+        else:
+            return
+        for item in items:
+            for title in entity_titles(item):
+                suggestion_index.add(title, SUGGEST_WEIGHTS['title'])
+    except Exception as e:
+        print(f"[AVISO] Falha ao indexar resultado de {method}: {e}")
+
+# ========================================
+# BUSCA: CATÁLOGO LOCAL (índice invertido)
+# ========================================
+# Tudo que vem do upstream (busca, charts, get_artist, get_album) entra num índice
+# invertido por palavra (sem acentos). Serve de busca degradada quando o upstream
+# está lento, limitado ou fora, e de prévia enquanto a busca real não chega.
+CATALOG_MAX_ENTITIES = int(os.getenv('CATALOG_MAX_ENTITIES', 20000))
+CATALOG_RESULT_TYPES = {'song': 'songs', 'video': 'songs', 'artist': 'artists', 'album': 'albums', 'playlist': 'playlists'}
+CATALOG_ENTITY_KEYS = ('resultType', 'title', 'artist', 'artists', 'album', 'videoId', 'browseId',
+                       'thumbnails', 'duration', 'year')
+
+def search_tokens(text):
+    return re.findall(r'\w+', fold_search_text(text))
+
+class CatalogIndex:
+    """Entidades já vistas (LRU) + índice palavra -> ids"""
+
+    def __init__(self, max_entities):
+        self.max_entities = max_entities
+        self._entities = OrderedDict()  # id -> (entidade, tokens, vezes vista)
+        self._postings = {}  # palavra -> set de ids
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.served = 0
+
+    def add(self, item, result_type=None, **overrides):
+        """Indexa um resultado do ytmusicapi (ignora o que não dá para mostrar na busca)"""
+        if not isinstance(item, dict):
+            return
+        entity = {k: item[k] for k in CATALOG_ENTITY_KEYS if item.get(k)}
+        entity.update(overrides)
+        entity['resultType'] = entity.get('resultType') or result_type
+        if entity['resultType'] not in CATALOG_RESULT_TYPES or not entity.get('thumbnails'):
+            return
+        entity_id = entity.get('videoId') if entity['resultType'] in ('song', 'video') else entity.get('browseId')
+        if not entity_id:
+            return
+        texts = entity_titles(entity)
+        album = entity.get('album')
+        if isinstance(album, dict) and isinstance(album.get('name'), str):
+            texts.append(album['name'])
+        tokens = frozenset(t for text in texts for t in search_tokens(text))
+        if not tokens:
+            return
+        entity = copy.deepcopy(entity)
+        key = (entity['resultType'], entity_id)
+        with self._lock:
+            previous = self._entities.pop(key, None)
+            seen = 1
+            if previous is not None:
+                seen += previous[2]
+                self._unlink(key, previous[1])
+            self._entities[key] = (entity, tokens, seen)
+            for token in tokens:
+                self._postings.setdefault(token, set()).add(key)
+            while len(self._entities) > self.max_entities:
+                old_key, (_, old_tokens, _) = self._entities.popitem(last=False)
+                self._unlink(old_key, old_tokens)
+
+    def _unlink(self, key, tokens):
+        for token in tokens:
+            ids = self._postings.get(token)
+            if ids is not None:
+                ids.discard(key)
+                if not ids:
+                    del self._postings[token]
+
+    def search(self, query, limits):
+        """{categoria: [entidades]} com todas as palavras (ou metade, se nada casar com todas)"""
+        tokens = set(search_tokens(query))
+        found = {category: [] for category in limits}
+        if not tokens:
+            return found
+        with self._lock:
+            self.queries += 1
+            matches = {}
+            for token in tokens:
+                for key in self._postings.get(token, ()):
+                    matches[key] = matches.get(key, 0) + 1
+            needed = len(tokens)
+            if not any(count == needed for count in matches.values()):
+                needed = (len(tokens) + 1) // 2
+            ranked = sorted(((count, self._entities[key][2], key) for key, count in matches.items()
+                             if count >= needed), reverse=True)
+            for _, _, key in ranked:
+                entity = self._entities[key][0]
+                category = CATALOG_RESULT_TYPES[entity['resultType']]
+                if category in found and len(found[category]) < limits[category]:
+                    found[category].append(copy.deepcopy(entity))
+            if any(found.values()):
+                self.served += 1
+        return found
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entities': len(self._entities),
+                'max_entities': self.max_entities,
+                'tokens': len(self._postings),
+                'queries': self.queries,
+                'served': self.served,
+            }
+
+catalog_index = CatalogIndex(CATALOG_MAX_ENTITIES)
+
+def index_catalog_result(method, args, result):
+    """Entidades de uma resposta do upstream -> catalog_index"""
+    if method == 'search':
+        for item in result or []:
+            catalog_index.add(item)
+    elif method == 'get_artist' and args:
+        catalog_index.add(result, 'artist', artist=result.get('name'), browseId=args[0])
+        for section, result_type in (('songs', 'song'), ('albums', 'album'), ('singles', 'album')):
+            for item in (result.get(section) or {}).get('results') or []:
+                catalog_index.add(item, result_type)
+    elif method == 'get_album' and args:
+        catalog_index.add(result, 'album', browseId=args[0])
+        album = {'name': result.get('title'), 'id': args[0]}
+        for track in result.get('tracks') or []:
+            # Faixas do álbum vêm sem thumbnail: usa a capa
+            catalog_index.add(track, 'song', album=album, thumbnails=track.get('thumbnails') or result.get('thumbnails'))
+
+def local_search(query):
+    """Busca só no catálogo local, já no formato das categorias do /api/search"""
+    limits = {category: spec['limit'] for category, spec in SEARCH_CATEGORIES.items()}
+    found = catalog_index.search(query, limits)
+    return {category: filter_category_results(category, items) for category, items in found.items()}
+
+# ========================================
+# BUSCA: EXECUTOR COMPARTILHADO + DEADLINE
+# ========================================
+# Um executor do processo para o fan-out da busca (antes: um ThreadPoolExecutor novo
+# por requisição). Categorias que passam do deadline ficam de fora e a resposta sai parcial.
+SEARCH_EXECUTOR_WORKERS = int(os.getenv('SEARCH_EXECUTOR_WORKERS', 16))
+SEARCH_EXECUTOR_MAX_QUEUE = 64  # Tarefas esperando um worker; acima disso recusa
+SEARCH_DEADLINE = float(os.getenv('SEARCH_DEADLINE', 3.0))  # Segundos
+
+# Categoria -> filtro do ytmusicapi, limite, resultType esperado, se exige browseId
+SEARCH_CATEGORIES = {
+    'songs': {'filter': 'songs', 'limit': 15, 'result_type': 'song', 'needs_browse_id': False, 'label': 'Músicas'},
+    'artists': {'filter': 'artists', 'limit': 6, 'result_type': 'artist', 'needs_browse_id': True, 'label': 'Artistas'},
+    'playlists': {'filter': 'playlists', 'limit': 6, 'result_type': 'playlist', 'needs_browse_id': True, 'label': 'Playlists'},
+    'albums': {'filter': 'albums', 'limit': 6, 'result_type': 'album', 'needs_browse_id': False, 'label': 'Álbuns'},
+}
+
+class UpstreamExecutor:
+    """ThreadPoolExecutor limitado com métricas de fila"""
+
+    def __init__(self, name, workers, max_queue):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.max_queued_seen = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+
+    def submit(self, fn, *args):
+        """Agenda fn(*args); levanta RuntimeError se a fila estiver cheia"""
+        priority = current_upstream_priority()  # As threads do executor não têm a requisição
+        with self._lock:
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                raise RuntimeError(f"Executor {self.name}: fila cheia")
+            self.queued += 1
+            self.submitted += 1
+            self.max_queued_seen = max(self.max_queued_seen, self.queued)
+
+        def run():
+            with self._lock:
+                self.queued -= 1
+                self.active += 1
+            _upstream_priority.value = priority
+            try:
+                return fn(*args)
+            finally:
+                _upstream_priority.value = None
+                with self._lock:
+                    self.active -= 1
+                    self.completed += 1
+
+        return self._executor.submit(run)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'active': self.active,
+                'queued': self.queued,
+                'max_queue': self.max_queue,
+                'max_queued_seen': self.max_queued_seen,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'rejected': self.rejected,
+            }
+
+search_executor = UpstreamExecutor('search', SEARCH_EXECUTOR_WORKERS, SEARCH_EXECUTOR_MAX_QUEUE)
+
+def filter_category_results(category, results):
+    """Mantém só resultados válidos da categoria, com a maior thumbnail primeiro"""
+    spec = SEARCH_CATEGORIES[category]
+    # ⚡ Filtrar e garantir alta qualidade de imagem
+    valid_results = []
+    for r in results:
+        if r.get('resultType') != spec['result_type'] or not r.get('thumbnails'):
+            continue
+        if spec['needs_browse_id'] and not r.get('browseId'):
+            continue
+        # Ordenar thumbnails por tamanho (maior = melhor qualidade)
+        r['thumbnails'].sort(key=lambda t: (t.get('width', 0) * t.get('height', 0)), reverse=True)
+        valid_results.append(r)
+    return valid_results
+
+def search_category(query, category):
+    """Busca uma categoria no upstream; None se falhar (o chamador usa o catálogo local)"""
+    try:
+        return filter_category_results(category, search_results(query, SEARCH_CATEGORIES[category]['filter'],
+                                                                 SEARCH_CATEGORIES[category]['limit']))
+    except Exception as e:
+        print(f"   [Erro] {SEARCH_CATEGORIES[category]['label']}: {e}")
+        return None
+
+def iter_search_categories(query, deadline=None):
+    """
+    Fan-out das categorias no executor compartilhado. Gera (categoria, resultados)
+    na ordem em que terminam; categorias recusadas ou fora do deadline saem com None.
+    """
+    deadline = SEARCH_DEADLINE if deadline is None else deadline
+    futures = {}
+    for category in SEARCH_CATEGORIES:
+        try:
+            futures[search_executor.submit(search_category, query, category)] = category
+        except RuntimeError as e:
+            print(f"   [AVISO] {SEARCH_CATEGORIES[category]['label']}: {e}")
+            yield category, None
+    
+    # As atrasadas continuam rodando e aquecem o cache do ytmusic para a próxima busca
+    pending = set(futures)
+    try:
+        for future in as_completed(futures, timeout=deadline):
+            pending.discard(future)
+            yield futures[future], future.result()
+    except TimeoutError:
+        pass
+    for future in pending:
+        yield futures[future], None
+
+def search_all_categories(query, deadline=None):
+    """Busca todas as categorias; retorna (resultados por categoria, categorias que faltaram)"""
+    results = {}
+    missing = []
+    for category, items in iter_search_categories(query, deadline):
+        if items is None:
+            missing.append(category)
+        else:
+            results[category] = items
+    return results, missing
+
 @app.route('/api/search')
 def search():
     """Buscar músicas no YouTube Music"""
@@ -454,101 +2995,100 @@ def search():
         start_time = datetime.now()
         print(f"[Debug] BUSCA: query='{query}'")
         
-        # ⚡ BUSCA PARALELA: Usar threads para buscar simultaneamente
-        from concurrent.futures import ThreadPoolExecutor, as_completed
-        import time
-        
-        all_results = []
-        
-        # ⚡ Funções de busca com limites MUITO REDUZIDOS para velocidade máxima
-        def search_songs():
-            try:
-                results = safe_ytmusic_call(lambda ytm: ytm.search(query, filter='songs', limit=15))
-                # ⚡ Filtrar e garantir alta qualidade de imagem
-                valid_results = []
-                for r in results:
-                    if r.get('resultType') == 'song' and r.get('thumbnails'):
-                        # Ordenar thumbnails por tamanho (maior = melhor qualidade)
-                        r['thumbnails'].sort(key=lambda t: (t.get('width', 0) * t.get('height', 0)), reverse=True)
-                        valid_results.append(r)
-                return valid_results
-            except Exception as e:
-                print(f"   [Erro] Músicas: {e}")
-                return []
-        
-        def search_artists():
-            try:
-                results = safe_ytmusic_call(lambda ytm: ytm.search(query, filter='artists', limit=6))
-                # ⚡ Filtrar e garantir alta qualidade de imagem
-                valid_results = []
-                for r in results:
-                    if r.get('resultType') == 'artist' and r.get('browseId') and r.get('thumbnails'):
-                        # Ordenar thumbnails por tamanho (maior = melhor qualidade)
-                        r['thumbnails'].sort(key=lambda t: (t.get('width', 0) * t.get('height', 0)), reverse=True)
-                        valid_results.append(r)
-                return valid_results
-            except Exception as e:
-                print(f"   [Erro] Artistas: {e}")
-                return []
+        # ⚡ BUSCA PARALELA no executor compartilhado, com deadline
+        by_category, missing = search_all_categories(query)
         
-        def search_playlists():
-            try:
-                results = safe_ytmusic_call(lambda ytm: ytm.search(query, filter='playlists', limit=6))
-                # ⚡ Filtrar e garantir alta qualidade de imagem
-                valid_results = []
-                for r in results:
-                    if r.get('resultType') == 'playlist' and r.get('browseId') and r.get('thumbnails'):
-                        # Ordenar thumbnails por tamanho (maior = melhor qualidade)
-                        r['thumbnails'].sort(key=lambda t: (t.get('width', 0) * t.get('height', 0)), reverse=True)
-                        valid_results.append(r)
-                return valid_results
-            except Exception as e:
-                print(f"   [Erro] Playlists: {e}")
-                return []
+        # Categorias que falharam ou passaram do deadline: catálogo local
+        local = []
+        if missing:
+            local_results = local_search(query)
+            for category in missing:
+                if local_results.get(category):
+                    by_category[category] = local_results[category]
+                    local.append(category)
         
-        def search_albums():
-            try:
-                results = safe_ytmusic_call(lambda ytm: ytm.search(query, filter='albums', limit=6))
-                # ⚡ Filtrar e garantir alta qualidade de imagem
-                valid_results = []
-                for r in results:
-                    if r.get('resultType') == 'album' and r.get('thumbnails'):
-                        # Ordenar thumbnails por tamanho (maior = melhor qualidade)
-                        r['thumbnails'].sort(key=lambda t: (t.get('width', 0) * t.get('height', 0)), reverse=True)
-                        valid_results.append(r)
-                return valid_results
-            except Exception as e:
-                print(f"   [Erro] Álbuns: {e}")
-                return []
-        
-        # ⚡ EXECUTAR BUSCAS EM PARALELO (4 threads)
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            # Submeter todas as buscas
-            future_songs = executor.submit(search_songs)
-            future_artists = executor.submit(search_artists)
-            future_playlists = executor.submit(search_playlists)
-            future_albums = executor.submit(search_albums)
-            
-            # Coletar resultados conforme ficam prontos
-            songs = future_songs.result()
-            artists = future_artists.result()
-            playlists = future_playlists.result()
-            albums = future_albums.result()
+        songs = by_category.get('songs', [])
+        artists = by_category.get('artists', [])
+        playlists = by_category.get('playlists', [])
+        albums = by_category.get('albums', [])
         
         # Adicionar todos os resultados
-        all_results.extend(songs)
-        all_results.extend(artists)
-        all_results.extend(playlists)
-        all_results.extend(albums)
+        all_results = songs + artists + playlists + albums
         
         elapsed = (datetime.now() - start_time).total_seconds() * 1000
         print(f"[OK] Busca concluída em {elapsed:.0f}ms: {len(songs)} músicas, {len(artists)} artistas, {len(playlists)} playlists, {len(albums)} álbuns")
+        if missing:
+            print(f"[AVISO] Busca parcial, categorias sem resposta do upstream: {', '.join(missing)}"
+                  + (f" (catálogo local: {', '.join(local)})" if local else ''))
         
-        return jsonify({'success': True, 'results': all_results})
+        return jsonify({'success': True, 'results': all_results, 'partial': bool(missing),
+                        'missing': missing, 'local': local})
     except Exception as e:
         print(f"[ERRO] ERRO na busca: {str(e)}")
         return jsonify({'error': f'Erro na busca: {str(e)}'}), 500
 
+# Formatos do stream: ndjson (uma linha JSON por evento, usado pela página de busca) ou sse (event:/data:)
+SEARCH_STREAM_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'sse': 'text/event-stream',
+}
+
+@app.route('/api/search/stream')
+def search_stream():
+    """
+    Busca progressiva: cada categoria é enviada assim que a chamada dela termina.
+    format=ndjson (padrão, usado pela página de busca) | sse
+    """
+    if not yt and not yt_public:
+        return jsonify({'error': 'YTMusic não conectado'}), 500
+    
+    query = request.args.get('q', '')
+    output_format = request.args.get('format', 'ndjson')
+    if not query:
+        return jsonify({'error': 'Query vazia'}), 400
+    if output_format not in SEARCH_STREAM_MIMETYPES:
+        return jsonify({'error': f'Formato inválido: {output_format}'}), 400
+    
+    def encode(event, payload):
+        if output_format == 'sse':
+            return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+        return json.dumps(payload) + '\n'
+    
+    def emit(category, items, local=False):
+        return encode('category', {'category': category, 'results': items, 'local': local})
+    
+    def generate():
+        start_time = time.time()
+        missing = []
+        print(f"[Debug] BUSCA (stream/{output_format}): query='{query}'")
+        
+        # Prévia do catálogo local enquanto o upstream não responde (substituída depois)
+        local_results = local_search(query)
+        for category, items in local_results.items():
+            if items:
+                yield emit(category, items, local=True)
+        
+        for category, items in iter_search_categories(query):
+            if items is None:
+                missing.append(category)
+                continue
+            yield emit(category, items)
+        
+        # Faltou o upstream: fica valendo o que veio do catálogo local
+        local = [category for category in missing if local_results.get(category)]
+        elapsed = (time.time() - start_time) * 1000
+        print(f"[OK] Busca (stream) concluída em {elapsed:.0f}ms" + (f", faltaram: {', '.join(missing)}" if missing else ''))
+        yield encode('done', {'done': True, 'partial': bool(missing), 'missing': missing, 'local': local})
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype=SEARCH_STREAM_MIMETYPES[output_format],
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',  # Proxies não devem segurar os pedaços
+        }
+    )
+
 @app.route('/api/watch/<videoId>')
 def get_watch_playlist(videoId):
     """Obter playlist de watch (músicas relacionadas)"""
@@ -556,7 +3096,7 @@ def get_watch_playlist(videoId):
         return jsonify({'error': 'YTMusic não conectado'}), 500
     
     try:
-        watch_playlist = safe_ytmusic_call(lambda ytm: ytm.get_watch_playlist(videoId))
+        watch_playlist = safe_ytmusic_call('get_watch_playlist', videoId)
         tracks = [ensure_thumbnail(t) for t in watch_playlist.get('tracks', [])]
         return jsonify({'success': True, 'related': tracks})
     except Exception as e:
@@ -569,7 +3109,7 @@ def get_song_info(videoId):
         return jsonify({'error': 'YTMusic não conectado'}), 500
     
     try:
-        song_info = safe_ytmusic_call(lambda ytm: ytm.get_song(videoId))
+        song_info = safe_ytmusic_call('get_song', videoId)
         return jsonify({'success': True, 'song': song_info})
     except Exception as e:
         return jsonify({'error': f'Erro ao obter informações da música: {str(e)}'}), 500
@@ -581,7 +3121,7 @@ def get_playlist(playlistId):
         return jsonify({'success': False, 'error': 'YTMusic não conectado'}), 500
     
     try:
-        playlist = safe_ytmusic_call(lambda ytm: ytm.get_playlist(playlistId, limit=1))
+        playlist = safe_ytmusic_call('get_playlist', playlistId, limit=1)
         # Remover tracks pesados - serão carregados separadamente
         playlist.pop('tracks', None)
         return jsonify({'success': True, 'playlist': ensure_thumbnail(playlist)})
@@ -598,7 +3138,7 @@ def get_more_playlist_songs(playlistId):
         page = int(request.args.get('page', 1))
         limit = 10
         
-        playlist = safe_ytmusic_call(lambda ytm: ytm.get_playlist(playlistId, limit=limit, offset=(page-1)*limit))
+        playlist = safe_ytmusic_call('get_playlist', playlistId, limit=limit, offset=(page-1)*limit)
         tracks = [ensure_thumbnail(t) for t in playlist.get('tracks', [])]
         
         return jsonify({
@@ -616,7 +3156,7 @@ def get_artist(artistId):
         return jsonify({'error': 'YTMusic não conectado'}), 500
     
     try:
-        artist = safe_ytmusic_call(lambda ytm: ytm.get_artist(artistId))
+        artist = safe_ytmusic_call('get_artist', artistId)
         # Garantir thumbnails no artista e nas músicas
         artist = ensure_thumbnail(artist)
         if artist.get('songs', {}).get('results'):
@@ -634,7 +3174,7 @@ def get_album(browseId):
         return jsonify({'success': False, 'error': 'YTMusic não conectado'}), 500
     
     try:
-        album = safe_ytmusic_call(lambda ytm: ytm.get_album(browseId))
+        album = safe_ytmusic_call('get_album', browseId)
         # Remover tracks pesados - serão carregados separadamente
         album.pop('tracks', None)
         return jsonify({'success': True, 'album': ensure_thumbnail(album)})
@@ -648,7 +3188,7 @@ def get_artist_albums(artistId):
         return jsonify({'error': 'YTMusic não conectado'}), 500
     
     try:
-        artist = safe_ytmusic_call(lambda ytm: ytm.get_artist(artistId))
+        artist = safe_ytmusic_call('get_artist', artistId)
         albums = [ensure_thumbnail(a) for a in artist.get('albums', {}).get('results', [])]
         return jsonify({'success': True, 'albums': albums})
     except Exception as e:
@@ -661,7 +3201,7 @@ def get_artist_playlists(artistId):
         return jsonify({'error': 'YTMusic não conectado'}), 500
     
     try:
-        artist = safe_ytmusic_call(lambda ytm: ytm.get_artist(artistId))
+        artist = safe_ytmusic_call('get_artist', artistId)
         playlists = artist.get('playlists', {}).get('results', [])
         return jsonify({'success': True, 'playlists': playlists})
     except Exception as e:
@@ -677,7 +3217,7 @@ def get_more_artist_playlists(artistId):
         page = int(request.args.get('page', 1))
         limit = 10
         
-        artist = safe_ytmusic_call(lambda ytm: ytm.get_artist(artistId))
+        artist = safe_ytmusic_call('get_artist', artistId)
         playlists = artist.get('playlists', {}).get('results', [])
         
         # Simular paginação (YTMusic não suporta offset para playlists)
@@ -703,7 +3243,7 @@ def get_more_artist_songs(artistId):
         page = int(request.args.get('page', 1))
         limit = 10
         
-        artist = safe_ytmusic_call(lambda ytm: ytm.get_artist(artistId))
+        artist = safe_ytmusic_call('get_artist', artistId)
         songs = artist.get('songs', {}).get('results', [])
         
         # Simular paginação
@@ -729,7 +3269,7 @@ def get_lyrics(videoId):
         print(f"[Lyrics] Buscando letras para: {videoId}")
         
         # PASSO 1: Buscar informações da música para obter browseId das letras
-        song_info = safe_ytmusic_call(lambda ytm: ytm.get_song(videoId))
+        song_info = safe_ytmusic_call('get_song', videoId)
         print(f"[Lyrics] Informações da música obtidas: {type(song_info)}")
         
         # Verificar se tem browseId de letras
@@ -750,7 +3290,7 @@ def get_lyrics(videoId):
         print(f"[Lyrics] browseId encontrado: {lyrics_browse_id}")
         
         # PASSO 2: Buscar as letras usando o browseId correto
-        lyrics_data = safe_ytmusic_call(lambda ytm: ytm.get_lyrics(lyrics_browse_id))
+        lyrics_data = safe_ytmusic_call('get_lyrics', lyrics_browse_id)
         print(f"[Lyrics] Resposta das letras: {type(lyrics_data)}")
         
         # Verificar se as letras existem e não estão vazias
@@ -784,7 +3324,7 @@ def get_related_songs(videoId):
     
     try:
         # Tenta usar get_watch_playlist ao invés de get_song_related
-        watch_playlist = safe_ytmusic_call(lambda ytm: ytm.get_watch_playlist(videoId))
+        watch_playlist = safe_ytmusic_call('get_watch_playlist', videoId)
         related = [ensure_thumbnail(t) for t in watch_playlist.get('tracks', [])[:10]]  # Pega apenas 10 músicas relacionadas
         return jsonify({'success': True, 'related': related})
     except Exception as e:
@@ -799,7 +3339,7 @@ def get_radio_playlist(videoId):
         return jsonify({'error': 'YTMusic não conectado'}), 500
     
     try:
-        radio_playlist = safe_ytmusic_call(lambda ytm: ytm.get_watch_playlist(videoId, radio=True))
+        radio_playlist = safe_ytmusic_call('get_watch_playlist', videoId, radio=True)
         return jsonify({'success': True, 'radio': radio_playlist})
     except Exception as e:
         return jsonify({'error': f'Erro ao obter rádio: {str(e)}'}), 500
@@ -866,7 +3406,7 @@ def page_artist(browseId):
         return render_template('partials/playlist.html', playlist={'id': browseId})
     
     try:
-        artist = safe_ytmusic_call(lambda ytm: ytm.get_artist(browseId))
+        artist = safe_ytmusic_call('get_artist', browseId)
         if not artist:
             raise Exception("Não foi possível carregar os dados do artista")
         
@@ -962,7 +3502,7 @@ def get_podcast(browseId):
         return jsonify({'success': False, 'error': 'YTMusic não conectado'}), 500
     
     try:
-        podcast = safe_ytmusic_call(lambda ytm: ytm.get_podcast(browseId))
+        podcast = safe_ytmusic_call('get_podcast', browseId)
         return jsonify({'success': True, 'podcast': podcast})
     except Exception as e:
         return jsonify({'success': False, 'error': f'Erro ao obter podcast: {str(e)}'}), 500
@@ -991,39 +3531,37 @@ def charts_songs(country):
         cache_key = f"charts_songs_{country_code}"
         
         # ⚡ VERIFICAR CACHE PRIMEIRO
-        cached_html = get_cached(cache_key)
-        if cached_html:
-            print(f"⚡ [CACHE HIT] Charts Songs {country_code}")
-            return cached_html
-        
-        print(f"⚡ [CHARTS SONGS] {country_code}")
-        
-        # ⚡ BUSCA DIRETA - SEM FALLBACKS (muito mais rápido!)
-        queries_map = {
-            'BR': 'top Brasil 2024',
-            'US': 'Billboard Hot 100 2024',
-            'MX': 'top Mexico 2024',
-            'AR': 'top Argentina 2024',
-            'GB': 'UK charts 2024',
-            'DE': 'top Germany 2024',
-            'FR': 'top France 2024',
-            'ES': 'top Spain 2024',
-            'IT': 'top Italy 2024',
-            'JP': 'top Japan 2024',
-            'KR': 'top Korea 2024'
-        }
+        def build():
+            print(f"⚡ [CHARTS SONGS] {country_code}")
+        
+            # ⚡ BUSCA DIRETA - SEM FALLBACKS (muito mais rápido!)
+            queries_map = {
+                'BR': 'top Brasil 2024',
+                'US': 'Billboard Hot 100 2024',
+                'MX': 'top Mexico 2024',
+                'AR': 'top Argentina 2024',
+                'GB': 'UK charts 2024',
+                'DE': 'top Germany 2024',
+                'FR': 'top France 2024',
+                'ES': 'top Spain 2024',
+                'IT': 'top Italy 2024',
+                'JP': 'top Japan 2024',
+                'KR': 'top Korea 2024'
+            }
+        
+            query = queries_map.get(country_code, f'top hits {country_code} 2024')
         
-        query = queries_map.get(country_code, f'top hits {country_code} 2024')
+            # ⚡ BUSCA DIRETA - limite reduzido para 6 (mais rápido!)
+            songs = safe_ytmusic_call('search', query, filter='songs', limit=6,
+                                      cache_ttl=YTMUSIC_CHARTS_CACHE_TTL)
         
-        # ⚡ BUSCA DIRETA - limite reduzido para 6 (mais rápido!)
-        songs = safe_ytmusic_call(lambda ytm: ytm.search(query, filter='songs', limit=6))
+            # Garantir videoId e title
+            songs = [s for s in songs if s.get('videoId') and s.get('title')][:6]
+            print(f"✅ {len(songs)} músicas")
         
-        # Garantir videoId e title
-        songs = [s for s in songs if s.get('videoId') and s.get('title')][:6]
-        print(f"✅ {len(songs)} músicas")
+            return render_template('components/cards_grid.html', items=songs, type='music')
         
-        html = render_template('components/cards_grid.html', items=songs, type='music')
-        return set_cached(cache_key, html)
+        return get_cached_or_build(cache_key, build, f"Charts Songs {country_code}")
     except Exception as e:
         print(f"[ERRO] em charts_songs: {str(e)}")
         import traceback
@@ -1044,15 +3582,13 @@ def trending_songs_endpoint():
     
     try:
         cache_key = "trending_songs"
-        cached_html = get_cached(cache_key)
-        if cached_html:
-            print(f"⚡ [CACHE HIT] Trending Songs")
-            return cached_html
-        
-        # ⚡ Limite reduzido para 6 (mais rápido!)
-        results = safe_ytmusic_call(lambda ytm: ytm.search('top hits 2024', filter='songs', limit=6))
-        html = render_template('components/cards_grid.html', items=results, type='music')
-        return set_cached(cache_key, html)
+        def build():
+            # ⚡ Limite reduzido para 6 (mais rápido!)
+            results = safe_ytmusic_call('search', 'top hits 2024', filter='songs', limit=6,
+                                         cache_ttl=YTMUSIC_CHARTS_CACHE_TTL)
+            return render_template('components/cards_grid.html', items=results, type='music')
+        
+        return get_cached_or_build(cache_key, build, "Trending Songs")
     except Exception as e:
         return render_template('components/error_state.html',
                              title='Erro ao carregar músicas',
@@ -1068,15 +3604,13 @@ def new_releases_endpoint():
     
     try:
         cache_key = "new_releases"
-        cached_html = get_cached(cache_key)
-        if cached_html:
-            print(f"⚡ [CACHE HIT] New Releases")
-            return cached_html
-        
-        # ⚡ Limite reduzido para 6
-        results = safe_ytmusic_call(lambda ytm: ytm.search('new albums 2024', filter='albums', limit=6))
-        html = render_template('components/cards_grid.html', items=results, type='album')
-        return set_cached(cache_key, html)
+        def build():
+            # ⚡ Limite reduzido para 6
+            results = safe_ytmusic_call('search', 'new albums 2024', filter='albums', limit=6,
+                                         cache_ttl=YTMUSIC_CHARTS_CACHE_TTL)
+            return render_template('components/cards_grid.html', items=results, type='album')
+        
+        return get_cached_or_build(cache_key, build, "New Releases")
     except Exception as e:
         return render_template('components/error_state.html',
                              title='Erro ao carregar lançamentos',
@@ -1092,31 +3626,29 @@ def trending_podcasts_endpoint():
     
     try:
         cache_key = "trending_podcasts"
-        cached_html = get_cached(cache_key)
-        if cached_html:
-            print(f"⚡ [CACHE HIT] Trending Podcasts")
-            return cached_html
-        
-        # ⚡ Limite reduzido para 8 (filtrado para 6)
-        results = safe_ytmusic_call(lambda ytm: ytm.search('best podcasts', limit=8))
-        
-        podcasts = []
-        for r in results:
-            if ('podcast' in str(r.get('resultType', '')).lower() or 
-                'podcast' in str(r.get('category', '')).lower() or
-                r.get('resultType') == 'playlist'):
+        def build():
+            # ⚡ Limite reduzido para 8 (filtrado para 6)
+            results = safe_ytmusic_call('search', 'best podcasts', limit=8,
+                                         cache_ttl=YTMUSIC_CHARTS_CACHE_TTL)
+        
+            podcasts = []
+            for r in results:
+                if ('podcast' in str(r.get('resultType', '')).lower() or 
+                    'podcast' in str(r.get('category', '')).lower() or
+                    r.get('resultType') == 'playlist'):
                 
-                if r.get('thumbnails'):
-                    thumbnails = sorted(r['thumbnails'], key=lambda x: x.get('width', 0) * x.get('height', 0), reverse=True)
-                    r['thumbnails'] = thumbnails
+                    if r.get('thumbnails'):
+                        thumbnails = sorted(r['thumbnails'], key=lambda x: x.get('width', 0) * x.get('height', 0), reverse=True)
+                        r['thumbnails'] = thumbnails
                 
-                podcasts.append(r)
+                    podcasts.append(r)
                 
-                if len(podcasts) >= 6:  # ⚡ Reduzido de 8 para 6
-                    break
+                    if len(podcasts) >= 6:  # ⚡ Reduzido de 8 para 6
+                        break
         
-        html = render_template('components/cards_grid.html', items=podcasts, type='podcast')
-        return set_cached(cache_key, html)
+            return render_template('components/cards_grid.html', items=podcasts, type='podcast')
+        
+        return get_cached_or_build(cache_key, build, "Trending Podcasts")
     except Exception as e:
         return render_template('components/error_state.html',
                              title='Erro ao carregar podcasts',
@@ -1135,37 +3667,35 @@ def charts_artists(country):
         cache_key = f"charts_artists_{country_code}"
         
         # ⚡ VERIFICAR CACHE
-        cached_html = get_cached(cache_key)
-        if cached_html:
-            print(f"⚡ [CACHE HIT] Charts Artists {country_code}")
-            return cached_html
-        
-        print(f"⚡ [CHARTS ARTISTS] {country_code}")
-        
-        # ⚡ BUSCA DIRETA - SEM FALLBACKS
-        queries_map = {
-            'BR': 'artistas brasileiros populares',
-            'US': 'top USA artists 2024',
-            'MX': 'artistas mexicanos populares',
-            'AR': 'artistas argentinos populares',
-            'GB': 'UK top artists',
-            'DE': 'top Germany artists',
-            'FR': 'top France artists',
-            'ES': 'top Spain artists',
-            'IT': 'top Italy artists',
-            'JP': 'top Japan artists',
-            'KR': 'top Korea artists'
-        }
+        def build():
+            print(f"⚡ [CHARTS ARTISTS] {country_code}")
+        
+            # ⚡ BUSCA DIRETA - SEM FALLBACKS
+            queries_map = {
+                'BR': 'artistas brasileiros populares',
+                'US': 'top USA artists 2024',
+                'MX': 'artistas mexicanos populares',
+                'AR': 'artistas argentinos populares',
+                'GB': 'UK top artists',
+                'DE': 'top Germany artists',
+                'FR': 'top France artists',
+                'ES': 'top Spain artists',
+                'IT': 'top Italy artists',
+                'JP': 'top Japan artists',
+                'KR': 'top Korea artists'
+            }
         
-        query = queries_map.get(country_code, f'top artists {country_code}')
+            query = queries_map.get(country_code, f'top artists {country_code}')
         
-        # ⚡ BUSCA DIRETA - limite reduzido para 6
-        artists = safe_ytmusic_call(lambda ytm: ytm.search(query, filter='artists', limit=6))
-        artists = [a for a in artists if a.get('browseId')][:6]
-        print(f"✅ {len(artists)} artistas")
+            # ⚡ BUSCA DIRETA - limite reduzido para 6
+            artists = safe_ytmusic_call('search', query, filter='artists', limit=6,
+                                        cache_ttl=YTMUSIC_CHARTS_CACHE_TTL)
+            artists = [a for a in artists if a.get('browseId')][:6]
+            print(f"✅ {len(artists)} artistas")
         
-        html = render_template('components/cards_grid.html', items=artists, type='artist')
-        return set_cached(cache_key, html)
+            return render_template('components/cards_grid.html', items=artists, type='artist')
+        
+        return get_cached_or_build(cache_key, build, f"Charts Artists {country_code}")
     except Exception as e:
         print(f"[ERRO] em charts_artists: {str(e)}")
         import traceback
@@ -1193,7 +3723,8 @@ def charts_videos(country):
         country_name = country_names.get(country.upper(), 'trending')
         query = f'top music videos {country_name} 2024'
         
-        videos = safe_ytmusic_call(lambda ytm: ytm.search(query, filter='videos', limit=10))
+        videos = safe_ytmusic_call('search', query, filter='videos', limit=10,
+                                   cache_ttl=YTMUSIC_CHARTS_CACHE_TTL)
         
         # Filtrar apenas vídeos válidos e garantir thumbnails
         videos = [ensure_thumbnail(v) for v in videos if v.get('videoId')]
@@ -1216,7 +3747,7 @@ def artist_top_songs_endpoint(browseId):
                              message='YTMusic não conectado')
     
     try:
-        artist = safe_ytmusic_call(lambda ytm: ytm.get_artist(browseId))
+        artist = safe_ytmusic_call('get_artist', browseId)
         songs = [ensure_thumbnail(s) for s in artist.get('songs', {}).get('results', [])[:10]]
         return render_template('components/cards_grid.html', items=songs, type='music')
     except Exception as e:
@@ -1233,7 +3764,7 @@ def album_tracks_endpoint(browseId):
         return jsonify({'success': False, 'error': 'YTMusic não conectado'}), 500
     
     try:
-        album = safe_ytmusic_call(lambda ytm: ytm.get_album(browseId))
+        album = safe_ytmusic_call('get_album', browseId)
         raw_tracks = album.get('tracks', [])
         album_thumbnails = album.get('thumbnails', [])
         
@@ -1253,7 +3784,7 @@ def album_tracks_endpoint(browseId):
             
             tracks.append(track)
         
-        return jsonify({'success': True, 'tracks': tracks})
+        return jsonify({'success': True, 'tracks': tracks, 'sprite': track_sprite_map('album', browseId, tracks)})
     except Exception as e:
         return jsonify({'success': False, 'error': f'Erro ao carregar faixas: {str(e)}'}), 500
 
@@ -1266,13 +3797,182 @@ def playlist_tracks_endpoint(playlistId):
         return jsonify({'success': False, 'error': 'YTMusic não conectado'}), 500
     
     try:
-        playlist = safe_ytmusic_call(lambda ytm: ytm.get_playlist(playlistId))
+        playlist = safe_ytmusic_call('get_playlist', playlistId)
         # ⚡ ULTRA RÁPIDO: Retornar tracks direto, já vêm com thumbnails da API
         tracks = playlist.get('tracks', [])
-        return jsonify({'success': True, 'tracks': tracks})
+        return jsonify({'success': True, 'tracks': tracks, 'sprite': track_sprite_map('playlist', playlistId, tracks)})
     except Exception as e:
         return jsonify({'success': False, 'error': f'Erro ao carregar músicas: {str(e)}'}), 500
 
+# ===== SPRITE ENDPOINTS =====
+# Thumbnails de TODAS as faixas de um álbum/playlist em UMA imagem (1 request em vez de 40)
+
+IMAGE_SPRITE_ENABLED = image_transcoder.Image is not None
+IMAGE_SPRITE_TILE = 80  # 40px na tela @2x
+IMAGE_SPRITE_COLUMNS = 10
+IMAGE_SPRITE_MAX_TRACKS = 100
+IMAGE_SPRITE_BUILD_TIMEOUT = 20
+IMAGE_SPRITE_FETCH_WORKERS = 8  # Downloads de thumbnails em paralelo (todos os sprites do processo)
+IMAGE_SPRITE_PARTIAL_MAX_AGE = 60  # Sprite com tiles faltando por falha passageira: não fica no cache
+
+image_sprite_executor = ThreadPoolExecutor(max_workers=IMAGE_SPRITE_FETCH_WORKERS, thread_name_prefix='sprite')
+
+def sprite_thumbnail_url(track):
+    """Thumbnail da própria faixa (capa quadrada nas playlists); frame do vídeo se não tiver"""
+    thumbnails = track.get('thumbnails') or [{}]
+    url = thumbnails[0].get('url') or ''
+    if is_known_image_host(url) and 'i.ytimg.com/vi/' not in url:
+        return url
+    # Faixas de álbum vêm sem thumbnail (ou com o hqdefault do /tracks): mqdefault basta para o tile
+    return f'https://i.ytimg.com/vi/{track["videoId"]}/mqdefault.jpg'
+
+def sprite_layout(tracks):
+    """Ordem das faixas no sprite: (video_ids, urls das thumbnails, versão, colunas, linhas)"""
+    video_ids = []
+    urls = []
+    for track in tracks:
+        video_id = track.get('videoId')
+        if video_id and video_id not in video_ids:
+            video_ids.append(video_id)
+            urls.append(sprite_thumbnail_url(track))
+            if len(video_ids) >= IMAGE_SPRITE_MAX_TRACKS:
+                break
+    if not video_ids:
+        return None
+    # Versão muda se a lista de faixas (ou as thumbnails) mudar: URL nova = cache novo no navegador
+    version = hashlib.sha1(','.join(video_ids + urls).encode('utf-8')).hexdigest()[:12]
+    columns = min(IMAGE_SPRITE_COLUMNS, len(video_ids))
+    rows = (len(video_ids) + columns - 1) // columns
+    return video_ids, urls, version, columns, rows
+
+def track_sprite_map(kind, item_id, tracks):
+    """Mapa JSON de offsets do sprite (o sprite em si é montado sob demanda)"""
+    if not IMAGE_SPRITE_ENABLED:
+        return None
+    layout = sprite_layout(tracks)
+    if not layout:
+        return None
+    video_ids, _, version, columns, rows = layout
+    tile = IMAGE_SPRITE_TILE
+    offsets = {}
+    for index, video_id in enumerate(video_ids):
+        col, row = index % columns, index // columns
+        offsets[video_id] = {'x': col * tile, 'y': row * tile, 'w': tile, 'h': tile, 'col': col, 'row': row}
+    return {
+        'url': f'/api/{kind}/{quote(item_id)}/sprite?v={version}',
+        'tile': tile,
+        'columns': columns,
+        'rows': rows,
+        'offsets': offsets,
+    }
+
+def is_transient_image_failure(reason):
+    """Falhas que podem sumir sozinhas (timeout, rede, 429, 5xx)"""
+    if isinstance(reason, int):
+        return reason == 429 or reason >= 500
+    return True
+
+def load_thumbnail_bytes(url):
+    """(bytes, motivo da falha) de uma thumbnail usando os caches do proxy; bytes None se falhar"""
+    cache_key = normalize_image_url(url)
+    entry = image_cache.get(cache_key)
+    if entry:
+        return entry['content'], None
+    meta = image_disk_cache.get(cache_key) if image_disk_cache else None
+    if meta:
+        try:
+            with open(meta['path'], 'rb') as f:
+                return f.read(), None
+        except OSError:
+            pass
+    reason = image_negative_cache.get(cache_key)
+    if reason is not None:
+        return None, reason
+    try:
+        result = image_fetch_flights.do(cache_key, lambda: fetch_upstream_image(url, cache_key), IMAGE_FETCH_WAIT_TIMEOUT)
+        return result['content'], None
+    except UpstreamRateLimited:
+        return None, 'shed'  # Descartada pelo rate limit: a imagem existe, fica fora do cache negativo
+    except ImageFetchError as e:
+        reason = e.status_code
+    except requests.exceptions.Timeout:
+        reason = 'timeout'
+    except (requests.exceptions.RequestException, TimeoutError):
+        reason = 'network'
+    image_negative_cache.add(cache_key, reason)
+    return None, reason
+
+def build_track_sprite(cache_key, urls, columns):
+    """Baixa as thumbnails (em paralelo) e monta o sprite no pool de processos"""
+    loaded = list(image_sprite_executor.map(load_thumbnail_bytes, urls))
+    images = [content for content, _ in loaded]
+    transient = sum(1 for content, reason in loaded if content is None and is_transient_image_failure(reason))
+    
+    pool = get_image_pool()
+    try:
+        future = pool.submit(image_transcoder.compose_sprite, images, IMAGE_SPRITE_TILE, columns)
+        content = future.result(timeout=IMAGE_SPRITE_BUILD_TIMEOUT)
+    except BrokenProcessPool:
+        discard_image_pool(pool)
+        raise
+    print(f"[SPRITE] {cache_key}: {sum(1 for i in images if i)}/{len(images)} thumbnails, {len(content) // 1024}KB")
+    if transient:
+        # Tiles cinza por falha passageira: não guardar, o próximo request monta de novo
+        return {'content': content, 'content_type': 'image/jpeg', 'partial': True}
+    return store_image(cache_key, content, 'image/jpeg')
+
+def sprite_image_response(kind, item_id, tracks):
+    """Serve o sprite do cache, ou monta uma única vez (single-flight)"""
+    layout = sprite_layout(tracks) if IMAGE_SPRITE_ENABLED else None
+    if not layout:
+        return jsonify({'success': False, 'error': 'Sprite indisponível'}), 404
+    _, urls, version, columns, rows = layout
+    cache_key = f'sprite:{kind}:{item_id}:{version}'
+    
+    entry = image_cache.get(cache_key)
+    if entry:
+        return memory_image_response(entry, 'HIT')
+    meta = image_disk_cache.get(cache_key) if image_disk_cache else None
+    if meta:
+        response = disk_image_response(meta, 'HIT-DISK')
+        if response:
+            return response
+    
+    result = image_fetch_flights.do(cache_key, lambda: build_track_sprite(cache_key, urls, columns), IMAGE_SPRITE_BUILD_TIMEOUT)
+    if result.get('partial'):
+        headers = image_response_headers(result['content_type'], 'PARTIAL')
+        headers['Cache-Control'] = f'public, max-age={IMAGE_SPRITE_PARTIAL_MAX_AGE}'
+        return Response(result['content'], mimetype=result['content_type'], headers=headers)
+    return Response(
+        result['content'],
+        mimetype=result['content_type'],
+        headers=image_response_headers(result['content_type'], 'MISS', result['etag'], result['last_modified'])
+    )
+
+@app.route('/api/album/<browseId>/sprite')
+def album_sprite_endpoint(browseId):
+    """Sprite com as thumbnails das faixas do álbum (offsets vêm em /tracks)"""
+    if not yt and not yt_public:
+        return jsonify({'success': False, 'error': 'YTMusic não conectado'}), 500
+    
+    try:
+        album = safe_ytmusic_call('get_album', browseId)
+        return sprite_image_response('album', browseId, album.get('tracks', []))
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'Erro ao montar sprite: {str(e)}'}), 500
+
+@app.route('/api/playlist/<playlistId>/sprite')
+def playlist_sprite_endpoint(playlistId):
+    """Sprite com as thumbnails das faixas da playlist (offsets vêm em /tracks)"""
+    if not yt and not yt_public:
+        return jsonify({'success': False, 'error': 'YTMusic não conectado'}), 500
+    
+    try:
+        playlist = safe_ytmusic_call('get_playlist', playlistId)
+        return sprite_image_response('playlist', playlistId, playlist.get('tracks', []))
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'Erro ao montar sprite: {str(e)}'}), 500
+
 # ===== PODCAST ENDPOINTS =====
 
 @app.route('/api/podcast/<browseId>/episodes')
@@ -1282,7 +3982,7 @@ def podcast_episodes_endpoint(browseId):
         return jsonify({'success': False, 'error': 'YTMusic não conectado'}), 500
     
     try:
-        podcast = safe_ytmusic_call(lambda ytm: ytm.get_podcast(browseId))
+        podcast = safe_ytmusic_call('get_podcast', browseId)
         episodes = []
         
         if podcast:
@@ -1297,7 +3997,7 @@ def podcast_episodes_endpoint(browseId):
             if not episodes and 'author' in podcast and podcast['author'] and 'id' in podcast['author']:
                 try:
                     author_id = podcast['author']['id']
-                    channel_data = safe_ytmusic_call(lambda ytm: ytm.get_artist(author_id))
+                    channel_data = safe_ytmusic_call('get_artist', author_id)
                     if channel_data and 'songs' in channel_data and 'results' in channel_data['songs']:
                         episodes = channel_data['songs']['results'][:20]
                 except Exception as channel_error:
@@ -1307,7 +4007,7 @@ def podcast_episodes_endpoint(browseId):
             if not episodes and 'title' in podcast:
                 try:
                     search_query = podcast['title']
-                    search_results = safe_ytmusic_call(lambda ytm: ytm.search(search_query, filter='videos', limit=10))
+                    search_results = safe_ytmusic_call('search', search_query, filter='videos', limit=10)
                     if search_results:
                         episodes = [e for e in search_results if e.get('resultType') == 'video']
                 except Exception as search_error:
@@ -1330,7 +4030,7 @@ def get_moods_endpoint():
                              message='YTMusic não conectado')
     
     try:
-        mood_data = safe_ytmusic_call(lambda ytm: ytm.get_mood_categories())
+        mood_data = safe_ytmusic_call('get_mood_categories')
         # mood_data é dict com {'Moods & moments': [...], 'Genres': [...]}
         moods = []
         if isinstance(mood_data, dict):
@@ -1354,22 +4054,19 @@ def get_moods_preview_endpoint():
     
     try:
         cache_key = "moods_preview"
-        cached_html = get_cached(cache_key)
-        if cached_html:
-            print(f"⚡ [CACHE HIT] Moods Preview")
-            return cached_html
+        def build():
+            mood_data = safe_ytmusic_call('get_mood_categories')
+            # mood_data é dict com {'Moods & moments': [...], 'Genres': [...]}
+            moods = []
+            if isinstance(mood_data, dict):
+                for category, items in mood_data.items():
+                    if isinstance(items, list):
+                        moods.extend(items)
+            # Pega apenas os primeiros 6
+            moods_preview = moods[:6] if len(moods) > 6 else moods
+            return render_template('partials/mood_categories.html', moods=moods_preview)
         
-        mood_data = safe_ytmusic_call(lambda ytm: ytm.get_mood_categories())
-        # mood_data é dict com {'Moods & moments': [...], 'Genres': [...]}
-        moods = []
-        if isinstance(mood_data, dict):
-            for category, items in mood_data.items():
-                if isinstance(items, list):
-                    moods.extend(items)
-        # Pega apenas os primeiros 6
-        moods_preview = moods[:6] if len(moods) > 6 else moods
-        html = render_template('partials/mood_categories.html', moods=moods_preview)
-        return set_cached(cache_key, html)
+        return get_cached_or_build(cache_key, build, "Moods Preview")
     except Exception as e:
         print(f"Erro em get_moods_preview: {str(e)}")
         return render_template('components/error_state.html',
@@ -1385,8 +4082,8 @@ def mood_playlists_endpoint(params):
                              message='YTMusic não conectado')
     
     try:
-        ytm_instance = yt_public if yt_public else yt
-        playlists = ytm_instance.get_mood_playlists(params)
+        pool = ytmusic_public_pool or ytmusic_auth_pool
+        playlists = pool.run(lambda ytm: ytm.get_mood_playlists(params))
         return render_template('components/cards_grid.html', items=playlists, type='playlist')
     except Exception as e:
         print(f"❌ Erro ao carregar mood playlists ({params}): {str(e)}")
@@ -1407,12 +4104,22 @@ def search_suggestions_endpoint():
         return ''
     
     try:
-        suggestions = safe_ytmusic_call(lambda ytm: ytm.get_search_suggestions(query))
+        # Índice local primeiro; upstream só se não houver candidatos suficientes
+        suggestions = suggestion_index.lookup(query)
+        source = 'local'
+        if len(suggestions) < SUGGEST_LOCAL_MIN:
+            try:
+                suggestions = safe_ytmusic_call('get_search_suggestions', query)
+                source = 'upstream'
+            except Exception as e:
+                # Upstream fora/limitado: o que houver no índice local
+                print(f"[AVISO] Sugestões do upstream falharam, usando índice local: {e}")
+        suggestion_index.record(source)
         html = '<div class="suggestions-list">'
-        for suggestion in suggestions[:5]:
-            html += f'<div class="suggestion-item p-2 hover:bg-white/10 cursor-pointer">{suggestion}</div>'
+        for suggestion in suggestions[:SUGGEST_RESULTS]:
+            html += f'<div class="suggestion-item p-2 hover:bg-white/10 cursor-pointer">{escape(suggestion)}</div>'
         html += '</div>'
-        return html
+        return Response(html, mimetype='text/html', headers={'X-Suggest-Source': source})
     except Exception as e:
         return ''
 
@@ -1442,7 +4149,7 @@ def search_results_html():
         filter_type = filter_map.get(result_type, 'songs')
         
         # Buscar no YouTube Music
-        results = safe_ytmusic_call(lambda ytm: ytm.search(query, filter=filter_type, limit=20))
+        results = search_results(query, filter_type, 20)
         
         # Garantir thumbnails
         results = [ensure_thumbnail(r) for r in results]
@@ -0,0 +1,106 @@
+"""
+Recodificação de imagens para WebP/AVIF e montagem de sprites (usado pelo /api/image-proxy)
+
+Roda dentro dos processos do pool do app.py. Fica num módulo separado e leve
+para que as tarefas enviadas aos filhos referenciem só isto (e o Pillow). Sob
+gunicorn os filhos não importam o app; com `python app.py` o spawn reexecuta o
+script principal, e o app.py pula a inicialização pesada (SPAWNED_CHILD).
+"""
+
+import io
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # Pillow é opcional: sem ele o proxy serve o original
+    Image = None
+    ImageOps = None
+    features = None
+
+# Capas e thumbnails têm no máximo ~1280px (maxresdefault 1280x720, =s800). Um PNG
+# de 2 MB pode declarar dimensões enormes e estourar a memória do processo ao decodificar.
+MAX_PIXELS = 1280 * 1280
+
+if Image is not None:
+    # Acima de 2x isto o Pillow recusa abrir (DecompressionBombError)
+    Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+
+# Formato -> Content-Type
+IMAGE_FORMATS = {
+    'avif': 'image/avif',
+    'webp': 'image/webp',
+}
+
+
+def supported_formats():
+    """Formatos que o Pillow instalado consegue gerar"""
+    if Image is None:
+        return set()
+    formats = set()
+    for fmt in IMAGE_FORMATS:
+        try:
+            if features.check(fmt):
+                formats.add(fmt)
+        except Exception:
+            pass
+    return formats
+
+
+def check_image_size(img):
+    """Recusa a imagem antes de decodificar se as dimensões passarem de MAX_PIXELS"""
+    width, height = img.size
+    if width * height > MAX_PIXELS:
+        raise ValueError(f"Imagem grande demais: {width}x{height}")
+
+
+def transcode_image(source, fmt, quality):
+    """Recodifica a imagem (bytes ou caminho do arquivo) para fmt.
+
+    Retorna os novos bytes, ou None se o resultado não ficou menor que o original.
+    """
+    if isinstance(source, bytes):
+        original_size = len(source)
+        source = io.BytesIO(source)
+    else:
+        with open(source, 'rb') as f:
+            data = f.read()
+        original_size = len(data)
+        source = io.BytesIO(data)
+
+    with Image.open(source) as img:
+        check_image_size(img)
+        if img.mode not in ('RGB', 'RGBA'):
+            has_alpha = img.mode in ('LA', 'PA') or 'transparency' in img.info
+            img = img.convert('RGBA' if has_alpha else 'RGB')
+        out = io.BytesIO()
+        if fmt == 'webp':
+            img.save(out, format='WEBP', quality=quality, method=4)
+        else:
+            img.save(out, format=fmt.upper(), quality=quality)
+
+    content = out.getvalue()
+    if len(content) >= original_size:
+        return None
+    return content
+
+
+def compose_sprite(images, tile, columns, quality=80):
+    """Monta um sprite (grade columns x N) com as imagens recortadas em quadrados de tile px.
+
+    Imagens ausentes (None) ou corrompidas ficam com o fundo neutro.
+    """
+    rows = (len(images) + columns - 1) // columns
+    sheet = Image.new('RGB', (columns * tile, rows * tile), (40, 40, 40))
+    for index, data in enumerate(images):
+        if not data:
+            continue
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                check_image_size(img)
+                thumb = ImageOps.fit(img.convert('RGB'), (tile, tile))
+        except Exception:
+            continue
+        sheet.paste(thumb, ((index % columns) * tile, (index // columns) * tile))
+
+    out = io.BytesIO()
+    sheet.save(out, format='JPEG', quality=quality, optimize=True)
+    return out.getvalue()
@@ -1262,39 +1262,69 @@ window.searchComponent = function() {
             }
             
             try {
-                // ⚡ Busca com AbortController para cancelamento
+                // ⚡ Busca PROGRESSIVA (NDJSON): cada categoria chega assim que fica pronta
                 const response = await fetch(
-                    `/api/search?q=${encodeURIComponent(this.searchQuery)}&filter=`,
+                    `/api/search/stream?q=${encodeURIComponent(this.searchQuery)}&format=ndjson`,
                     { signal: this.currentSearchController.signal }
                 );
-                const data = await response.json();
+                if (!response.ok || !response.body) {
+                    throw new Error(`HTTP ${response.status}`);
+                }
+                
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                const byCategory = {};  // Categoria do upstream substitui a prévia local
+                let partial = true;  // Até chegar a linha final {done} (stream cortado = incompleto)
+                this.searchResults = [];
+                this.categorizeResults();
                 
-                if (data.success) {
-                    this.searchResults = data.results || [];
+                const handleLine = (line) => {
+                    if (!line.trim()) return;
+                    const chunk = JSON.parse(line);
+                    if (chunk.done) {
+                        partial = chunk.partial !== false;
+                        return;
+                    }
+                    byCategory[chunk.category] = chunk.results || [];
+                    this.searchResults = Object.values(byCategory).flat();
+                    this.categorizeResults();
+                    // Primeira categoria chegou: já dá para mostrar
+                    this.isLoading = false;
+                    console.log(`⚡ ${chunk.category} em ${(performance.now() - startTime).toFixed(0)}ms`);
                     
-                    // ⚡ CACHE: Salvar resultado no cache (máximo 20 buscas)
+                    // Carregar artista principal assim que os artistas chegarem
+                    if (chunk.category === 'artists') {
+                        this.loadMainArtist();
+                    }
+                };
+                
+                while (true) {
+                    const { value, done } = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
+                    let newline;
+                    while ((newline = buffer.indexOf('\n')) >= 0) {
+                        handleLine(buffer.slice(0, newline));
+                        buffer = buffer.slice(newline + 1);
+                    }
+                }
+                handleLine(buffer);
+                
+                // ⚡ CACHE: Salvar resultado no cache (máximo 20 buscas) - só buscas completas
+                if (!partial) {
                     if (this.searchCache.size >= 20) {
                         // Remover mais antigo (primeiro item)
                         const firstKey = this.searchCache.keys().next().value;
                         this.searchCache.delete(firstKey);
                     }
                     this.searchCache.set(query, { results: this.searchResults });
-                    
-                    // Categorize results into their respective types
-                    this.categorizeResults();
-                    
-                    const elapsed = (performance.now() - startTime).toFixed(0);
-                    console.log(`⚡ Busca concluída em ${elapsed}ms`);
-                    
-                    // Carregar artista principal e suas músicas (imediato)
-                    this.loadMainArtist();
                 } else {
-                    console.error('❌ Erro na busca:', data.error);
-                    this.searchResults = [];
-                    this.categorizedResults = {
-                        artists: [], playlists: [], songs: [], albums: []
-                    };
+                    console.warn('⚠️ Busca parcial ou interrompida (não vai para o cache)');
                 }
+                
+                const elapsed = (performance.now() - startTime).toFixed(0);
+                console.log(`⚡ Busca concluída em ${elapsed}ms`);
             } catch (error) {
                 // Ignorar erros de abort (cancelamento)
                 if (error.name === 'AbortError') {